@@ -0,0 +1,378 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+
+# This file is part of pam-accesscontrol.
+#
+#    Copyright (C) 2017,2018  Alexander Naumov <alexander_naumov@opensuse.org>
+#
+#    PAM-ACCESSCONTROL is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PAM-ACCESSCONTROL is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PAM-ACCESSCONTROL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Latency benchmark of the PAM hooks of accesscontrol.py.
+
+The module is driven with a fake pamh object, a synthetic config directory,
+a stubbed NSS (user's groups) and session source and a generated logfile of
+the current month, all in a temporary directory. Nothing of the real system
+(/etc, /run, /var/log, syslog) is touched.
+
+For each combination of the parameters it reports p50/p99 latency and the
+median peak of allocated memory (tracemalloc, Python 3 only) of
+pam_sm_authenticate(), pam_sm_open_session() and pam_sm_close_session().
+'cold' is the import of the module plus the first authentication, like
+pam_python does it for a new PAM handle.
+
+With --startup N each hook is called in N fresh interpreters instead: the
+import of the module (stdlib modules included, like in a new sshd child)
+and the call are measured separately, with the real NSS (user running the
+benchmark) and the number of modules the import loads. Run it with --module
+of the old version of the module to compare.
+
+usage: accesscontrol_bench.py [--rules 10,1000] [--groups 10,100] [--sessions 10,1000]
+                              [--log-lines 1000,100000] [--iterations 200]
+                              [--nss-delay MS] [--no-snapshot] [--json]
+                              [--module PATH] [--startup N]
+"""
+
+import sys, os, time, json, random, shutil, tempfile, itertools, subprocess, pwd
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib", "security", "accesscontrol.py")
+SERVICES = ["sshd", "sshd-key", "login", "su", "sudo"]
+clock = getattr(time, "perf_counter", time.time)
+
+
+def load_module(path):
+  """
+  It loads a fresh copy of the PAM module (empty caches, like a new PAM handle).
+  """
+  try:
+    import importlib.util
+    spec = importlib.util.spec_from_file_location("accesscontrol", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+  except ImportError:
+    import imp
+    module = imp.load_source("accesscontrol", path)
+  return module
+
+
+class FakeException(Exception):
+  pam_result = 7
+
+
+class FakePamh(object):
+  """
+  The part of pam_python's PamHandle used by accesscontrol.py.
+  """
+  PAM_SUCCESS = 0
+  PAM_AUTH_ERR = 7
+  exception = FakeException
+
+  def __init__(self, handle, service, user, rhost):
+    self.pamh = handle
+    self.service = service
+    self.user = user
+    self.rhost = rhost
+
+  def get_user(self, prompt=None):
+    return self.user
+
+
+def users(n):
+  return ["user%d" % i for i in range(n)]
+
+
+def hosts(n):
+  return ["10.%d.%d.%d" % (i // 65536 % 256, i // 256 % 256, i % 256) for i in range(n)]
+
+
+def make_config(path, rules, groups, sessions):
+  """
+  Synthetic config directory: 'rules' OPEN/CLOSE/NET/NUMBER rules over a pool
+  of users and 'groups' groups, most of logins are allowed. ASK rules are not
+  used (no windows).
+  """
+  rnd = random.Random(rules)
+  os.makedirs(path)
+  lines = ["DEFAULT:OPEN", "DEBUG:false", "SESSION-SOURCE:bench", "DAEMON-SOCKET:" + path + "/no.sock"]
+  pool = users(max(rules, 10))
+  for i in range(rules):
+    service = SERVICES[i // 10 % len(SERVICES)]
+    kind = i % 10
+    if kind < 5:
+      lines.append("%s %s USER %s" % (service, rnd.choice(["OPEN"] * 4 + ["CLOSE"]), ",".join(rnd.sample(pool, 3))))
+    elif kind < 8:
+      lines.append("%s OPEN GROUP group%d" % (service, rnd.randrange(groups)))
+    elif kind < 9:
+      lines.append("%s CLOSE NET 172.%d.%d.0/24" % (service, i // 256 % 256, i % 256))
+    else:
+      lines.append("%s NUMBER GROUP group%d:%d" % (service, rnd.randrange(groups), sessions + 10))
+  with open(os.path.join(path, "bench.conf"), "w") as f:
+    f.write("\n".join(lines) + "\n")
+
+
+def make_log(ac, lines):
+  """
+  Logfile of the current month with 'lines' records and its index.
+  """
+  FILE = ac.log_file()
+  now = time.strftime("%Y-%m-%d %H:%M:%S")
+  last = {}
+  pool_users, pool_hosts = users(1000), hosts(997)
+  with open(FILE, "wb") as f:
+    for i in range(lines):
+      who = pool_users[i % 1000] + "@" + pool_hosts[i % 997]
+      last[who] = f.tell()
+      f.write(("\t".join([now, "sshd", "OPEN", who, "access granted"]) + "\n").encode())
+  for who in last:
+    ac.index_log(FILE, who, "OPEN", last[who])
+
+
+def setup(tmp, params, module):
+  """
+  It prepares the temporary tree and returns function which loads the module
+  configured to use it.
+  """
+  make_config(tmp + "/conf", params['rules'], params['groups'], params['sessions'])
+  for d in ["state", "cache", "log", "lib"]:
+    os.makedirs(tmp + "/" + d)
+
+  logged = [users(1000)[i % 1000] for i in range(params['sessions'])]
+  membership = {}
+  rnd = random.Random(params['groups'])
+  for user in users(max(params['rules'], 10)):
+    membership[user] = set("group%d" % rnd.randrange(params['groups']) for i in range(5))
+
+  def lookup_groups(login, gids, ttl):
+    if params['nss_delay']: time.sleep(params['nss_delay'] / 1000.0)
+    return membership.get(login)
+
+  def load():
+    ac = load_module(module)
+    ac.CONFIG_DIR = tmp + "/conf/"
+    ac.SNAPSHOT_FILE = tmp + "/lib/rules.snapshot"
+    ac.GROUP_CACHE_FILE = tmp + "/cache/groups.json"
+    ac.STATE_DIR = tmp + "/state/"
+    ac.LOG_DIR = tmp + "/log/"
+    ac.LOGIND_USERS = tmp + "/no-logind/"
+    if not hasattr(ac, "emit"): ac.log = lambda msg: None   # module without leveled logger
+    ac.emit = lambda priority, message: None
+    ac.lookup_groups = lookup_groups
+    ac.session_sources['bench'] = ac.fake_session_source(logged)
+    return ac
+
+  ac = load()
+  make_log(ac, params['log_lines'])
+  if params['snapshot']:
+    ac.write_snapshot()
+  return load
+
+
+# Started by startup() in a fresh interpreter: only sys, os and time are
+# imported before the module, like in pam_python.
+STARTUP_CHILD = """
+import sys, os, time
+clock = getattr(time, "perf_counter", time.time)
+path, tmp, hook, login = sys.argv[1:5]
+modules = len(sys.modules)
+start = clock()
+sys.path.insert(0, os.path.dirname(path))
+ac = __import__(os.path.basename(path)[:-3])
+imported = clock()
+
+ac.CONFIG_DIR = tmp + "/conf/"
+ac.SNAPSHOT_FILE = tmp + "/lib/rules.snapshot"
+ac.GROUP_CACHE_FILE = tmp + "/cache/groups.json"
+ac.STATE_DIR = tmp + "/state/"
+ac.LOG_DIR = tmp + "/log/"
+ac.LOGIND_USERS = tmp + "/no-logind/"
+if not hasattr(ac, "emit"): ac.log = lambda msg: None   # module without leveled logger
+ac.emit = lambda priority, message: None
+ac.session_sources['bench'] = ac.fake_session_source([login])
+
+class Exception_(Exception):
+  pam_result = 7
+
+class Pamh(object):
+  PAM_SUCCESS, PAM_AUTH_ERR, exception = 0, 7, Exception_
+  pamh, service, user, rhost = 1, "sshd", login, "10.0.0.1"
+  def get_user(self, prompt=None):
+    return self.user
+
+start_hook = clock()
+ret = getattr(ac, "pam_sm_" + hook)(Pamh(), 0, [])
+done = clock()
+sys.stdout.write("%f %f %d %s\\n" % (imported - start, done - start_hook, len(sys.modules) - modules, ret))
+"""
+
+
+def startup(params, module, n):
+  """
+  It calls each hook in 'n' fresh interpreters (see STARTUP_CHILD).
+  """
+  tmp = tempfile.mkdtemp(prefix="pam-accesscontrol-bench-")
+  try:
+    setup(tmp, params, module)
+    # a copy of the module: its bytecode cache is written to tmp, not to the tree
+    os.makedirs(tmp + "/module")
+    copy = os.path.join(tmp, "module", os.path.basename(module))
+    shutil.copy(module, copy)
+    login = pwd.getpwuid(os.getuid()).pw_name
+
+    report = []
+    for hook in ["authenticate", "open_session", "close_session"]:
+      times = {'import': [], 'hook': [], 'total': []}
+      modules = []
+      for i in range(n + 1):
+        out = subprocess.check_output([sys.executable, "-E", "-c", STARTUP_CHILD, copy, tmp, hook, login])
+        imported, called, loaded, ret = out.decode().split()
+        if i == 0: continue  # bytecode is compiled
+        times['import'].append(float(imported))
+        times['hook'].append(float(called))
+        times['total'].append(float(imported) + float(called))
+        modules.append(int(loaded))
+      row = {'hook': hook, 'modules': percentile(modules, 50)}
+      for name in ['import', 'hook', 'total']:
+        row[name + '_p50_ms'] = round(percentile(times[name], 50) * 1000, 3)
+        row[name + '_p99_ms'] = round(percentile(times[name], 99) * 1000, 3)
+      report.append(row)
+    return report
+  finally:
+    shutil.rmtree(tmp)
+
+
+def percentile(values, p):
+  values = sorted(values)
+  if not values:
+    return float("nan")
+  return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def measure(call, traced):
+  """
+  It returns (seconds, peak of allocated bytes or None, return value) of one call.
+  """
+  if traced:
+    tracemalloc.start()
+    ret = call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return None, peak, ret
+  start = clock()
+  ret = call()
+  return clock() - start, None, ret
+
+
+def run(params, module):
+  tmp = tempfile.mkdtemp(prefix="pam-accesscontrol-bench-")
+  try:
+    load = setup(tmp, params, module)
+    pool = [(user, hosts(251)[i % 251]) for i, user in enumerate(users(max(params['rules'], 10)))]
+    rnd = random.Random(0)
+    results = dict((hook, {'time': [], 'alloc': []}) for hook in ["cold", "authenticate", "open_session", "close_session"])
+
+    # allocations are measured in separate (first) iterations: tracing slows everything down
+    traced_iterations = min(20, params['iterations']) if tracemalloc else 0
+    for n in range(traced_iterations + params['iterations']):
+      traced = n < traced_iterations
+      user, host = rnd.choice(pool)
+      pamh = FakePamh(n, "sshd", user, host)
+      holder = {}
+
+      def cold():
+        holder['ac'] = load()
+        return holder['ac'].pam_sm_authenticate(pamh, 0, [])
+
+      for hook, call in [("cold", cold),
+                         ("authenticate", lambda: holder['ac'].pam_sm_authenticate(pamh, 0, [])),
+                         ("open_session", lambda: holder['ac'].pam_sm_open_session(pamh, 0, [])),
+                         ("close_session", lambda: holder['ac'].pam_sm_close_session(pamh, 0, []))]:
+        seconds, peak, ret = measure(call, traced)
+        if traced: results[hook]['alloc'].append(peak)
+        else:      results[hook]['time'].append(seconds)
+        # like sshd: session is closed only if it was opened
+        if hook == "open_session" and ret != FakePamh.PAM_SUCCESS:
+          break
+
+    report = []
+    for hook in ["cold", "authenticate", "open_session", "close_session"]:
+      times, allocs = results[hook]['time'], results[hook]['alloc']
+      report.append({'hook': hook,
+                     'p50_ms': round(percentile(times, 50) * 1000, 3),
+                     'p99_ms': round(percentile(times, 99) * 1000, 3),
+                     'alloc_kib': round(percentile(allocs, 50) / 1024.0, 1) if allocs else None})
+    return report
+  finally:
+    shutil.rmtree(tmp)
+
+
+def numbers(value):
+  return [int(x) for x in value.split(",") if x]
+
+
+def main(args):
+  opts = {'rules': [10, 1000], 'groups': [10], 'sessions': [10], 'log_lines': [1000],
+          'iterations': 200, 'nss_delay': 0.0, 'snapshot': True, 'json': False, 'module': MODULE, 'startup': 0}
+  while args:
+    name = args.pop(0)
+    if   name == "--no-snapshot": opts['snapshot'] = False
+    elif name == "--json":        opts['json'] = True
+    elif name in ["--rules", "--groups", "--sessions", "--log-lines"] and args:
+      opts[name[2:].replace("-", "_")] = numbers(args.pop(0))
+    elif name == "--iterations" and args: opts['iterations'] = int(args.pop(0))
+    elif name == "--nss-delay" and args:  opts['nss_delay'] = float(args.pop(0))
+    elif name == "--module" and args:     opts['module'] = args.pop(0)
+    elif name == "--startup" and args:    opts['startup'] = int(args.pop(0))
+    else:
+      print (__doc__.strip().split("\n\n")[-1])
+      return 1
+
+  rows = []
+  if opts['startup'] and not opts['json']:
+    print ("%-40s %-14s %12s %12s %12s %12s %8s" % ("parameters", "hook", "import p50", "call p50",
+                                                     "total p50", "total p99", "modules"))
+  elif not opts['json']:
+    print ("%-40s %-14s %10s %10s %10s" % ("parameters", "hook", "p50 ms", "p99 ms", "alloc KiB"))
+  for rules, groups, sessions, log_lines in itertools.product(opts['rules'], opts['groups'], opts['sessions'], opts['log_lines']):
+    params = {'rules': rules, 'groups': groups, 'sessions': sessions, 'log_lines': log_lines,
+              'iterations': opts['iterations'], 'nss_delay': opts['nss_delay'], 'snapshot': opts['snapshot']}
+    label = "rules=%d groups=%d sessions=%d log=%d" % (rules, groups, sessions, log_lines)
+    if opts['startup']:
+      for row in startup(params, opts['module'], opts['startup']):
+        row.update(params)
+        rows.append(row)
+        if not opts['json']:
+          print ("%-40s %-14s %12.3f %12.3f %12.3f %12.3f %8d" % (label, row['hook'], row['import_p50_ms'],
+                 row['hook_p50_ms'], row['total_p50_ms'], row['total_p99_ms'], row['modules']))
+          label = ""
+      continue
+
+    for row in run(params, opts['module']):
+      row.update(params)
+      rows.append(row)
+      if not opts['json']:
+        print ("%-40s %-14s %10.3f %10.3f %10s" % (label, row['hook'], row['p50_ms'], row['p99_ms'],
+                                                   "-" if row['alloc_kib'] is None else row['alloc_kib']))
+        label = ""
+  if opts['json']:
+    print (json.dumps(rows, indent=1))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -15,64 +15,484 @@
 #    You should have received a copy of the GNU General Public License
 #    along with PAM-ACCESSCONTROL.  If not, see <http://www.gnu.org/licenses/>.
 
-import subprocess as sp
-import syslog, os, sys, re, time, datetime, glob, grp, pwd
-
-from ctypes import *
-from ctypes.util import find_library
+# The module is imported by pam_python in every sshd child (and other PAM
+# processes), so only cheap modules are imported here. subprocess, socket,
+# threading and ctypes are imported by the functions which need them.
+import syslog, os, re, time, grp, pwd, json, fcntl, contextlib, zlib, bisect, errno
+try:
+  from _thread import get_ident
+except ImportError:
+  from thread import get_ident
 
 log_prefix = ""
 
+CONFIG_DIR = "/etc/pam-accesscontrol.d/"
+SNAPSHOT_FILE = "/var/lib/pam-accesscontrol/rules.snapshot"
+SNAPSHOT_VERSION = 4
+
+# Days of the week for TIME schedules (see schedule())
+DAYS = ['MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT', 'SUN']
+WEEK = 7 * 24 * 60
+
+# Priority of rules: CLOSE > ASK > OPEN (> DEFAULT)
+PRIORITY = {'OPEN': 1, 'ASK': 2, 'CLOSE': 3}
+GROUP_CACHE_FILE = "/var/cache/pam-accesscontrol/groups.json"
+LOGIND_USERS = "/run/systemd/users/"
+STATE_DIR = "/run/pam-accesscontrol/"
+DAEMON_SOCKET = STATE_DIR + "daemon.sock"
+NOTIFICATIONS = "/usr/share/pam-accesscontrol/notifications.py"
+LOG_DIR = "/var/log/"
+
+# Index of logfile: hash table of fixed size records (see index_log())
+LOG_INDEX_SLOTS  = 65536
+LOG_INDEX_RECORD = 128
+LOG_INDEX_PROBES = 64
+
+rules_cache = {'stamp': None, 'rules': None}
+
+# Lookups done during one PAM call (authentication, open/close session).
+# It's cleared at the beginning of each pam_sm_* call.
+call_cache = {'groups': {}, 'users': None, 'mode': None, 'timings': {}, 'nested': [],
+              'service': None, 'level': None, 'reserve': True, 'thread': None,
+              'pending': [], 'settings': None, 'number_groups': None}
+
+# Log levels (LOGLEVEL setting) and their syslog priorities
+LOG_LEVELS = {'ERROR': 0, 'INFO': 1, 'DEBUG': 2}
+LOG_PRIORITIES = [syslog.LOG_ERR, syslog.LOG_INFO, syslog.LOG_DEBUG]
+
+# Rate limit of ERROR and INFO messages: LOG_RATE records of the same
+# (formatted) message per LOG_RATE_PERIOD seconds; at most LOG_RATE_MESSAGES
+# messages are remembered: message => [start of the period, number of records]
+LOG_RATE = 10
+LOG_RATE_PERIOD = 60
+LOG_RATE_MESSAGES = 1000
+log_rate = {}
+
+# Upper bounds (ms) of histogram buckets of TIMING:TRUE (see save_timings())
+TIMING_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+clock = getattr(time, "perf_counter", time.time)
+
+# Copy of GROUP_CACHE_FILE, used if GROUP-CACHE-TTL is set:
+# users: login => [time, list of groups or None for unknown user]
+# gids:  gid => [time, group name]
+groups_cache = {'stamp': None, 'users': {}, 'gids': {}}
+groups_cache_stats = {'hit': 0, 'miss': 0, 'stale': 0, 'negative': 0}
+groups_refresh = set()
+
+# getgrouplist(3) of glibc for Python 2, loaded on first use (see user_gids())
+getgrouplist = None
+
+
+def emit(priority, message):
+  syslog.syslog(priority, log_prefix + message)
+
+
+def write_log_message(level, message, args):
+  """
+  It sends the message to syslog, if 'level' is enabled (see log_level()).
+  Message is formatted ('message % args') only if it's really sent, so
+  arguments could be passed as they are:
+
+    debug("groups of '%s': %s", login, groups)
+
+  The same ERROR or INFO message (with the same arguments) is sent at most
+  LOG_RATE times per LOG_RATE_PERIOD seconds; number of suppressed ones is
+  added to the next.
+
+  DEBUG messages sent before the level is known (neither the rule set nor
+  the answer of pam-accesscontrold is loaded yet) wait in call_cache['pending'].
+  """
+  if level == LOG_LEVELS['DEBUG'] and call_cache['level'] is None and rules_cache['rules'] is None:
+    call_cache['pending'].append((message, args))
+    return
+  if level > log_level():
+    return
+  message = str(message % args if args else message)
+  if level < LOG_LEVELS['DEBUG']:
+    now = time.time()
+    if message not in log_rate and len(log_rate) >= LOG_RATE_MESSAGES:
+      for m in [m for m in log_rate if now - log_rate[m][0] >= LOG_RATE_PERIOD]:
+        del log_rate[m]
+      if len(log_rate) >= LOG_RATE_MESSAGES:
+        log_rate.clear()
+    rate = log_rate.setdefault(message, [now, 0])
+    if now - rate[0] >= LOG_RATE_PERIOD:
+      suppressed = rate[1] - LOG_RATE
+      rate[0], rate[1] = now, 0
+      if suppressed > 0:
+        message = message + " (" + str(suppressed) + " same messages suppressed)"
+    rate[1] += 1
+    if rate[1] > LOG_RATE:
+      return
+  emit(LOG_PRIORITIES[level], message)
+
+
+def log(message, *args):
+  write_log_message(LOG_LEVELS['INFO'], message, args)
+
+
+def debug(message, *args):
+  write_log_message(LOG_LEVELS['DEBUG'], message, args)
+
+
+def error(message, *args):
+  write_log_message(LOG_LEVELS['ERROR'], message, args)
+
+
+def log_level():
+  """
+  Log level of the current call: 'LOGLEVEL-<SERVICE>:<LEVEL>' of the
+  service, otherwise 'LOGLEVEL:<LEVEL>', otherwise DEBUG for 'DEBUG:TRUE'
+  and INFO. LEVEL is ERROR, INFO or DEBUG.
+  """
+  if call_cache['level'] is None:
+    call_cache['level'] = LOG_LEVELS['INFO']   # messages of rule_set() itself
+    rules = rule_set()
+    name = rules['SETTINGS'].get('LOGLEVEL-' + str(call_cache['service']).upper(),
+                                 rules['SETTINGS'].get('LOGLEVEL', 'DEBUG' if rules['DEBUG'] else 'INFO'))
+    set_log_level(LOG_LEVELS.get(str(name).upper(), LOG_LEVELS['INFO']))
+  return call_cache['level']
+
+
+def set_log_level(level):
+  """
+  It sets log level of the current call and sends the pending DEBUG messages.
+  """
+  call_cache['level'] = level
+  pending, call_cache['pending'] = call_cache['pending'], []
+  for message, args in pending:
+    write_log_message(LOG_LEVELS['DEBUG'], message, args)
+
+
+def new_call(prefix, SERVICE=None):
+  """
+  It should be called at the beginning of each PAM call (or daemon request):
+  sets prefix of syslog messages, service (see log_level()) and forgets
+  lookups of previous call.
+  """
+  global log_prefix
+  log_prefix = prefix
+  call_cache['service'] = SERVICE
+  call_cache['level'] = None
+  call_cache['groups'] = {}
+  call_cache['users'] = None
+  call_cache['mode'] = None
+  call_cache['reserve'] = True
+  call_cache['timings'] = {}
+  call_cache['nested'] = []
+  call_cache['thread'] = get_ident()
+  call_cache['pending'] = []
+  call_cache['settings'] = None
+  call_cache['number_groups'] = None
+
+
+@contextlib.contextmanager
+def stage(name):
+  """
+  It measures time spent in a stage of the PAM call (config, parse, groups,
+  sessions, log, dialog, daemon). Time of nested stages is not counted twice:
+
+    with stage('log'):
+      ...
 
-def log(log_message):
-  syslog.syslog(log_prefix + str(log_message))
+  Only stages of the thread which started the call (see new_call()) are
+  measured; in other threads (group cache refresh) it does nothing.
+  """
+  if call_cache['thread'] != get_ident():
+    yield
+    return
+  start = clock()
+  call_cache['nested'].append(0.0)
+  try:
+    yield
+  finally:
+    spent = clock() - start
+    timings = call_cache['timings']
+    timings[name] = timings.get(name, 0.0) + spent - call_cache['nested'].pop()
+    if call_cache['nested']: call_cache['nested'][-1] += spent
 
 
+def timed(name):
+  """
+  Decorator: the whole function is the stage 'name' (see stage()).
+  """
+  def decorator(function):
+    def call(*args, **kwargs):
+      with stage(name):
+        return function(*args, **kwargs)
+    call.__name__ = function.__name__
+    call.__doc__ = function.__doc__
+    return call
+  return decorator
+
+
+def instrumented(hook):
+  """
+  Decorator of pam_sm_* functions: with 'TIMING:TRUE' one summary record
+  with durations of all stages is logged for each call and durations are
+  added to the histograms (see save_timings()).
+  """
+  def decorator(function):
+    def call(pamh, flags, argv):
+      start = clock()
+      try:
+        return function(pamh, flags, argv)
+      finally:
+        total = clock() - start
+        if call_cache['pending']:
+          log_level()
+        try:
+          if str(settings().get('TIMING', '')).upper() == "TRUE":
+            timings = dict(call_cache['timings'])
+            timings['other'] = max(total - sum(timings.values()), 0.0)
+            log("timing %s %.2fms: %s", hook, total * 1000,
+                " ".join("%s=%.2f" % (k, timings[k] * 1000) for k in sorted(timings)))
+            save_timings(hook, timings, total)
+        except Exception as e:
+          error("can't save timings: %s", e)
+    call.__name__ = function.__name__
+    call.__doc__ = function.__doc__
+    return call
+  return decorator
+
+
+def save_timings(hook, timings, total):
+  """
+  It adds durations (ms) of the call to the histograms in STATE_DIR/timings.json
+  (shown by 'pam-accesscontrol stats'):
+  hook => stage => {'count', 'sum', 'max', 'buckets': counts of TIMING_BUCKETS + overflow}
+  """
+  with locked_state(STATE_DIR + "timings.json") as state:
+    stages = state.setdefault(hook, {})
+    for name, spent in list(timings.items()) + [('total', total)]:
+      ms = spent * 1000
+      h = stages.setdefault(name, {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * (len(TIMING_BUCKETS) + 1)})
+      h['count'] += 1
+      h['sum'] += ms
+      h['max'] = max(h['max'], ms)
+      h['buckets'][bisect.bisect_left(TIMING_BUCKETS, ms)] += 1
+
+
+def log_file(month=None):
+  """
+  Logfile of the month (format YYYY-MM); current month by default.
+  """
+  if month is None: month = time.strftime("%Y-%m")
+  return LOG_DIR + 'pam-accesscontrol-' + month + '.log'
+
+
+@timed('log')
 def create_log(SERVICE, rhost, user, mode, msg):
   """
   It creates new entry in the logfile. The format of log-entry is:
   date <SPACE> current time <TAB> service name <TAB> rule <TAB> username@hostname <TAB> some_text <newline>
+  TABs, newlines and backslashes inside of fields are escaped (see escape_log()).
+  Granted sessions are also saved in the index of the logfile (see check_log()).
   """
-  now  = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-  FILE = '/var/log/pam-accesscontrol-' + str(datetime.datetime.now().strftime("%Y-%m")) + '.log'
+  now  = time.strftime("%Y-%m-%d %H:%M:%S")
+  FILE = log_file()
 
   if not rhost: rhost = "localhost"
+  who = str(user) + "@" + str(rhost)
+  offset = write_log(FILE, "\t".join([now] + [escape_log(f) for f in [SERVICE, mode, who, msg]]) + "\n")
+
+  if offset is not None and granted(msg):
+    index_log(FILE, who, str(mode), offset)
+
+
+def write_log(FILE, record):
+  """
+  It appends the record to the logfile by a single write(2) to the file opened
+  with O_APPEND, so records of simultaneous logins are never mixed. If
+  'LOG-SOCKET:<path>' is set, the record is sent to this UNIX datagram socket
+  instead (to a local log collector); logfile is used only
+  if the socket is not available.
+  Returns offset of the record in the logfile (-1 if it was sent to the socket)
+  or None in case of error.
+  """
+  data = record if isinstance(record, bytes) else record.encode('utf-8')
+
+  path = setting('LOG-SOCKET', '')
+  if path:
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+      sock.connect(path)
+      sock.send(data)
+      return -1
+    except socket.error as e:
+      error("can't send log record to %s: %s", path, e)
+    finally:
+      sock.close()
+
   try:
-    fd = open(FILE, 'a+')
-    fd.write("%s%s%s%s%s\n" % (now.ljust(23), SERVICE.ljust(10), str(mode).ljust(10), (str(user) + "@" + str(rhost)).ljust(50), msg.ljust(15)))
-    fd.close()
-  except:
-    log("can't open/write logfile " + FILE)
+    fd = os.open(FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+      os.write(fd, data)
+      return os.lseek(fd, 0, 1) - len(data)
+    finally:
+      os.close(fd)
+  except OSError:
+    error("can't open/write logfile %s", FILE)
+    return None
+
+
+def escape_log(field):
+  return str(field).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
 
+def unescape_log(field):
+  return re.sub(r"\\(.)", lambda m: {"t": "\t", "n": "\n"}.get(m.group(1), m.group(1)), field)
+
+
+def granted(msg):
+  """
+  Is it log message about new session ("creating new session", "access granted")?
+  """
+  return len(msg.split()) > 1 and msg.split()[1] in ["new", "granted"]
 
+
+def parse_log(line):
+  """
+  It splits the line of logfile to the LIST: date, time, service, rule,
+  username@hostname and text. Returns None for broken lines.
+  Old logfiles (before v0.97) used spaces instead of TABs.
+  """
+  if "\t" in line:
+    L = line.rstrip("\n").split("\t")
+    if len(L) != 5 or len(L[0].split(" ")) != 2:
+      return None
+    if "\\" in line:
+      L = L[:1] + [unescape_log(f) for f in L[1:]]
+    return L[0].split(" ") + L[1:]
+
+  L = line.split()
+  if len(L) < 6:
+    return None
+  return L[:5] + [" ".join(L[5:])]
+
+
+def index_slots(fd, who):
+  """
+  It yields (position, key, record) of index slots which can be used by
+  'who' (linear probing).
+  """
+  key = who if isinstance(who, bytes) else who.encode('utf-8')
+  slot = zlib.crc32(key) & 0xffffffff
+  for i in range(LOG_INDEX_PROBES):
+    pos = ((slot + i) % LOG_INDEX_SLOTS) * LOG_INDEX_RECORD
+    os.lseek(fd, pos, 0)
+    yield pos, key, os.read(fd, LOG_INDEX_RECORD)
+
+
+def index_log(FILE, who, mode, offset):
+  """
+  Index of logfile (FILE with '.idx' instead of '.log') maps 'user@host'
+  to the rule and the offset of its last granted session. It's a hash
+  table of fixed size records:
+  username@hostname (96 bytes) rule (8 bytes) offset (23 bytes) <newline>
+  """
+  try:
+    fd = os.open(FILE[:-4] + ".idx", os.O_RDWR | os.O_CREAT, 0o600)
+  except OSError as e:
+    error("can't open index of logfile %s: %s", FILE, e)
+    return
+
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    for pos, key, record in index_slots(fd, who):
+      if len(key) > 96:
+        break
+      if len(record) < LOG_INDEX_RECORD or record[:1] == b"\0" or record[:96].rstrip(b"\0") == key:
+        os.lseek(fd, pos, 0)
+        os.write(fd, key.ljust(96, b"\0") + mode[:8].ljust(8).encode() + str(offset).rjust(23).encode() + b"\n")
+        return
+    error("can't add '%s' to index of logfile %s", who, FILE)
+  finally:
+    os.close(fd)
+
+
+def indexed_log(FILE, who):
+  """
+  It returns rule of the last granted session of 'who' from the index
+  of logfile. Returns None if index or 'who' is not there.
+  """
+  try:
+    fd = os.open(FILE[:-4] + ".idx", os.O_RDONLY)
+  except OSError:
+    return None
+
+  try:
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    for pos, key, record in index_slots(fd, who):
+      if len(record) < LOG_INDEX_RECORD or record[:1] == b"\0":
+        return None
+      if record[:96].rstrip(b"\0") == key:
+        return record[96:104].decode().strip()
+  finally:
+    os.close(fd)
+  return None
+
+
+def reversed_log(FILE, block=65536):
+  """
+  It reads logfile block by block from the end and yields its lines in
+  reversed order.
+  """
+  with open(FILE, 'rb') as fd:
+    fd.seek(0, 2)
+    pos = fd.tell()
+    rest = b""
+    while pos > 0:
+      size = min(block, pos)
+      pos = pos - size
+      fd.seek(pos)
+      lines = (fd.read(size) + rest).split(b"\n")
+      rest = lines[0]
+      for line in reversed(lines[1:]):
+        yield line.decode('utf-8', 'replace')
+    yield rest.decode('utf-8', 'replace')
+
+
+def scan_log(FILE, who):
+  """
+  It looks for the last granted session of 'who' in the logfile itself
+  (from the end). Returns its rule or None.
+  """
+  try:
+    for line in reversed_log(FILE):
+      L = parse_log(line)
+      if L and L[4] == who and granted(L[5]):
+        return L[3]
+  except (OSError, IOError):
+    error("can't open/read logfile %s", FILE)
+  return None
+
+
+@timed('sessions')
 def check_log(SERVICE, rhost, user):
   """
   This funtion can be used to figure out is the current SSH session last on or not.
   In fact we have mulisessions (sessions inside other sessions), but we should be
   notified only about last one.
+  Rule of the last granted session is taken from the index of logfile; the
+  logfile itself is scanned only if it's not indexed (yet).
   """
-  FILE = '/var/log/pam-accesscontrol-' + str(datetime.datetime.now().strftime("%Y-%m")) + '.log'
+  FILE = log_file()
+  who  = str(user + "@" + rhost)
 
-  try:
-    fd = open(FILE, 'a+')
-    logfile = reversed(fd.read().split("\n"))
-    fd.close()
-  except:
-    log("can't open/read logfile " + FILE)
+  mode = indexed_log(FILE, who)
+  if mode is None:
+    mode = scan_log(FILE, who)
+  if mode is None:
     return 0
 
-  for l in logfile:
-    if len(l) > 0:
-      L = [L for L in l.split(" ") if len(L)>0 and re.search('[a-zA-Z]', L)]
-      if L[2] == str(user + "@" + rhost):
-        if L[4] in ["new", "granted"]:
-          log("closing session - user:" + str(user) + " host:"+str(rhost))
-          create_log(SERVICE, rhost, user, L[1], "closing session")
-          if L[1] == "ASK":
-            return 1
-          else:
-            return 0
-  return 0
+  log("closing session - user:%s host:%s", user, rhost)
+  create_log(SERVICE, rhost, user, mode, "closing session")
+  if mode == "ASK":
+    return 1
+  else:
+    return 0
 
 
 def ids(LIST):
@@ -84,41 +504,415 @@ def not_upper_last_element(config):
   Last rule's element is a username. We won't 'upper' it. Rest should be
   'upper'ed to fix difference between capital and lowercase letters
   (to be able to use both in the config file).
+  The list of usernames could be also followed by 'FROM <networks>' - the
+  4th element is not 'upper'ed as well.
   We also should be carefull with unnecessary spaces that generates excess
   rule's options.
   """
   conf = []
   for line in config:
     if len(line.split(" "))>1:
-      line = " ".join([x for x in line.split(" ") if len(x) > 0])
-      line = " ".join([x for x in line.upper().split(" ")[:-1]]) + " " + line.split(" ")[-1]
+      words = [x for x in line.split(" ") if len(x) > 0]
+      line = " ".join([x if i in [3, len(words)-1] else x.upper() for i, x in enumerate(words)])
     conf.append(line)
   return conf
 
 
-def configuration():
+def address(host):
+  """
+  It converts IPv4/IPv6 address to the tuple (FAMILY, INT); FAMILY is '4'
+  or '6'. IPv4-mapped IPv6 addresses (::ffff:a.b.c.d) become IPv4.
+  Returns None if 'host' is not an IP address (empty, hostname).
+  """
+  if not host:
+    return None
+  try:
+    from _socket import inet_pton, AF_INET, AF_INET6   # without slow import of socket.py
+  except ImportError:
+    from socket import inet_pton, AF_INET, AF_INET6
+  import binascii
+  host = str(host).split("%")[0]
+  for family, name in [(AF_INET, '4'), (AF_INET6, '6')]:
+    try:
+      value = int(binascii.hexlify(inet_pton(family, host)), 16)
+    except (IOError, OSError, ValueError):
+      continue
+    if name == '6' and value >> 32 == 0xffff:
+      return '4', value & 0xffffffff
+    return name, value
+  return None
+
+
+def network(cidr):
+  """
+  It parses network 'ADDRESS[/PREFIXLEN]' and returns tuple (FAMILY, PREFIXLEN,
+  KEY) used in the network index (see net_scopes()). ValueError for broken
+  network.
+  """
+  host, length = (cidr.split("/", 1) + [None])[:2]
+  addr = address(host)
+  if addr is None:
+    raise ValueError("broken network address: " + str(cidr))
+
+  bits = 32 if addr[0] == '4' else 128
+  if ":" in host and addr[0] == '4': # IPv4-mapped
+    bits = 128
+  length = bits if length is None else int(length)
+  if length < 0 or length > bits:
+    raise ValueError("broken prefix length: " + str(cidr))
+
+  if bits == 128 and addr[0] == '4':
+    if length < 96:
+      raise ValueError("broken prefix length: " + str(cidr))
+    bits, length = 32, length - 96
+  return addr[0], length, "%x" % (addr[1] >> (bits - length))
+
+
+def net_scopes(nets, host):
+  """
+  It looks 'host' up in the network index of service: FAMILY => list of
+  [PREFIXLEN, {KEY: rules}] sorted from the longest prefix. Returns list of
+  rules ({'USERS':..., 'GROUPS':...}) of all networks containing 'host',
+  the most specific network first. One dictonary lookup per prefix length
+  (at most 33 for IPv4 and 129 for IPv6), independent of number of networks.
+  """
+  addr = address(host)
+  if addr is None:
+    return []
+
+  bits = 32 if addr[0] == '4' else 128
+  scopes = []
+  for length, prefixes in nets.get(addr[0], ()):
+    key = "%x" % (addr[1] >> (bits - length))
+    if key in prefixes:
+      scopes.append(prefixes[key])
+  return scopes
+
+
+def day_minute(HHMM):
+  """
+  It converts 'HH:MM' to minutes since midnight (ValueError for broken time).
+  """
+  hours, minutes = [int(x) for x in HHMM.split(":")]
+  if hours < 0 or minutes < 0 or minutes > 59 or hours * 60 + minutes > 24 * 60:
+    raise ValueError("broken time: " + str(HHMM))
+  return hours * 60 + minutes
+
+
+def schedule(TIME):
+  """
+  It compiles schedule 'DAY[-DAY][/HH:MM-HH:MM],...' (e.g. 'MON-FRI/08:00-18:00',
+  'SAT', '22:00-06:00' for every night) to the sorted LIST of minutes of the week:
+  [start1, end1, start2, end2, ...]. Time belongs to the schedule if bisect_right()
+  of it's minute is odd (see in_schedule()). ValueError for broken (or empty)
+  schedule.
+  """
+  items = ids(TIME.upper())
+  if not items:
+    raise ValueError("broken schedule: no days or hours in '" + str(TIME) + "'")
+
+  intervals = []
+  for item in items:
+    if "/" in item:                 days, hours = item.split("/", 1)
+    elif item[:3] in DAYS:          days, hours = item, "00:00-24:00"
+    else:                           days, hours = "MON-SUN", item
+
+    first, last = (days.split("-", 1) * 2)[:2]
+    start, end = [day_minute(x) for x in hours.split("-", 1)] if "-" in hours else [None, None]
+    if first not in DAYS or last not in DAYS or start is None or start == end:
+      raise ValueError("broken schedule: " + str(item))
+
+    day = DAYS.index(first)
+    while True:
+      begin = day * 24 * 60 + start
+      finish = day * 24 * 60 + end + (24 * 60 if end < start else 0)
+      intervals += [[begin, min(finish, WEEK)]] + ([[0, finish - WEEK]] if finish > WEEK else [])
+      if DAYS[day] == last: break
+      day = (day + 1) % 7
+
+  table = []
+  for begin, finish in sorted(intervals):
+    if table and begin <= table[-1]:
+      table[-1] = max(table[-1], finish)
+    else:
+      table += [begin, finish]
+  return table
+
+
+def in_schedule(table, now=None):
+  """
+  It checks is the (local) time 'now' in the compiled schedule (see schedule()).
+  """
+  now = now or time.localtime()
+  return bisect.bisect_right(table, now.tm_wday * 24 * 60 + now.tm_hour * 60 + now.tm_min) % 2 == 1
+
+
+def config_files():
+  """
+  Config files: CONFIG_DIR/*.conf (like glob, but without importing it).
+  """
+  try:
+    return sorted(CONFIG_DIR + f for f in os.listdir(CONFIG_DIR) if f.endswith('.conf') and f[0] != '.')
+  except OSError:
+    return []
+
+
+def config_stamp(files):
+  """
+  Identity of the config files: name, inode, mtime and size of each file.
+  Editing, replacing (rename), adding or removing a file changes the stamp.
+  """
+  stamp = []
+  for cur_file in files:
+    try:
+      st = os.stat(cur_file)
+      stamp.append((cur_file, st.st_ino, st.st_mtime, st.st_size))
+    except OSError:
+      stamp.append((cur_file, 0, 0, 0))
+  return tuple(stamp)
+
+
+def configuration(files=None):
   """
   Reading rules list from the config files.
   """
-  conf_files = sorted(glob.glob('/etc/pam-accesscontrol.d/*.conf'))
+  if files is None:
+    files = config_files()
   all_conf = []
-  if conf_files:
-    for cur_file in conf_files:
-      try:
-        with open(cur_file, 'r') as fd:
-          conf = fd.read().split("\n")
-          conf = not_upper_last_element(conf)
-          all_conf = all_conf + conf
-      except:
-        log("can't open file: " + cur_file)
+  for cur_file in files:
+    try:
+      with open(cur_file, 'r') as fd:
+        conf = fd.read().split("\n")
+        conf = not_upper_last_element(conf)
+        all_conf = all_conf + conf
+    except:
+      error("can't open file: %s", cur_file)
   #log("config: " + str(all_conf))
   return all_conf
 
 
+def compile_rules(config):
+  """
+  It parses the (normalized) config lines ONCE and returns the rule set:
+
+  DEFAULT  - 'CLOSE' or 'OPEN' (see get_default())
+  DEBUG    - True or False (see get_default())
+  SETTINGS - all other 'NAME:VALUE' lines (see setting())
+  SERVICES - service => tuple of correctly defined rules, in the same format
+             as config_parser() returns them: {'OPTION': 'OPEN USER', 'LIST': [...]}
+  INDEX    - service => USERS  => {login: rule}
+                        GROUPS => {group: rule}
+                        NUMBER => tuple of NUMBER rule parameters ('group:number')
+                        NET    => network index (see net_scopes()), every
+                                  network has own USERS and GROUPS; 'NET'
+                                  rules are saved as GROUPS => {'ALL': rule}
+                        TIME   => list of indexes (USERS, GROUPS, NET) of the
+                                  rules limited by TIME, one for each compiled
+                                  SCHEDULE (see schedule())
+             For users and groups listed in many rules the rule with the
+             highest PRIORITY is saved.
+
+  Broken rules are ignored (for security reason). The rule set is shared
+  between calls (see rule_set()), so it should be treated as read-only.
+  """
+  DEBUG    = False
+  DEFAULT  = 'CLOSE'
+  SETTINGS = {}
+
+  for line in config:
+    if ":" in line and " " not in line and line[0] != "#":
+      SETTINGS[line.split(":")[0].upper()] = line.split(":", 1)[1]
+
+    line = line.upper()
+    if line[:8] == "DEFAULT:":
+      if line.split(":")[1] in ['CLOSE', 'OPEN']:
+        DEFAULT = line.split(":")[1]
+      else:
+        error("default: CLOSE")
+
+    if line[:6] == "DEBUG:":  DEBUG = line.split(":")[1]
+
+  DEBUG = (DEBUG == 'TRUE')
+
+  services = {}
+  index = {}
+  for rule in [c for c in config if len(c) > 5 and c[0] != "#"]:
+    opt = rule.split(" ")
+    if len(opt) == 1 and ":" in rule:
+      continue # DEFAULT:, DEBUG:
+
+    elif len(opt) < 4 or len(opt) % 2 or len(set(opt[4::2])) != len(opt[4::2]) or not set(opt[4::2]) <= set(['FROM', 'TIME']):
+      if DEBUG: debug("broken rule, wrong number of options... skipping: " +str(rule))
+
+    elif opt[1] not in ['OPEN', 'CLOSE', 'ASK','NUMBER']:
+      if DEBUG: debug("second parameter is broken: " +str(rule))
+
+    elif opt[2] not in ['USER', 'GROUP', 'NET']:
+      if DEBUG: debug("third parameter is broken: " +str(rule))
+
+    elif (opt[1] == "NUMBER" or opt[2] == "NET") and "FROM" in opt[4::2]:
+      if DEBUG: debug("NUMBER and NET rules can't be limited by FROM: " +str(rule))
+
+    elif opt[1] == "NUMBER" and (opt[2] == "NET" or "TIME" in opt[4::2]):
+      if DEBUG: debug("NUMBER rule can't be used for NET or limited by TIME: " +str(rule))
+
+    else:
+      clauses = dict(zip(opt[4::2], opt[5::2]))
+      try:
+        nets = [network(n) for n in ids(clauses.get('FROM', opt[3] if opt[2] == "NET" else ""))]
+        table = schedule(clauses['TIME']) if 'TIME' in clauses else None
+      except ValueError as e:
+        if DEBUG: debug(str(e) + ": " + str(rule))
+        continue
+
+      entry = {'OPTION': opt[1] + " " + opt[2], 'LIST': ids(opt[3])}
+      for clause in clauses: entry[clause] = ids(clauses[clause])
+      services.setdefault(opt[0], []).append(entry)
+      if opt[0] not in index:
+        index[opt[0]] = {'USERS': {}, 'GROUPS': {}, 'NUMBER': [], 'NET': {}, 'TIME': []}
+
+      if opt[1] == "NUMBER":
+        index[opt[0]]['NUMBER'].extend(ids(opt[3]))
+        continue
+
+      # rules limited by TIME have own index (one for each schedule)
+      base = index[opt[0]]
+      if table is not None:
+        timed = [t for t in base['TIME'] if t['SCHEDULE'] == table]
+        if not timed:
+          timed = [{'SCHEDULE': table, 'USERS': {}, 'GROUPS': {}, 'NET': {}}]
+          base['TIME'].append(timed[0])
+        base = timed[0]
+
+      if opt[2] == "NET":
+        scopes = [(n, 'GROUPS', ["ALL"]) for n in nets]
+      elif nets:
+        scopes = [(n, opt[2] + "S", ids(opt[3])) for n in nets]
+      else:
+        scopes = [(None, opt[2] + "S", ids(opt[3]))]
+
+      for net, target, names in scopes:
+        if net is None:
+          rules = base
+        else:
+          rules = base['NET'].setdefault(net[0], {}).setdefault(net[1], {}).setdefault(net[2], {'USERS': {}, 'GROUPS': {}})
+        for name in names:
+          if PRIORITY[opt[1]] > PRIORITY.get(rules[target].get(name), 0):
+            rules[target][name] = opt[1]
+
+  for service in index.values():
+    for nets in [service['NET']] + [t['NET'] for t in service['TIME']]:
+      for family in nets:
+        nets[family] = [[length, nets[family][length]] for length in sorted(nets[family], reverse=True)]
+
+  return freeze_rules({'DEFAULT': DEFAULT, 'DEBUG': DEBUG, 'SETTINGS': SETTINGS,
+                       'SERVICES': services, 'INDEX': index})
+
+
+def freeze_rules(rules):
+  """
+  Lists of the rule set become tuples (compiled or loaded from snapshot).
+  """
+  services = rules['SERVICES']
+  index = rules['INDEX']
+  for service in index:
+    services[service] = tuple(services[service])
+    index[service]['NUMBER'] = tuple(index[service]['NUMBER'])
+  return rules
+
+
+def write_snapshot(FILE=None):
+  """
+  It compiles the config files and saves the rule set together with the
+  stamp of the files it was built from (see config_stamp()). Snapshot is
+  written to a temporary file and renamed, so readers get the old or the
+  new rule set, but never a half-written one.
+  """
+  if FILE is None: FILE = SNAPSHOT_FILE
+  files = config_files()
+  stamp = config_stamp(files)
+  rules = compile_rules(configuration(files))
+
+  make_dir(os.path.dirname(FILE), 0o755)
+
+  tmp = FILE + ".tmp." + str(os.getpid())
+  with open(tmp, 'w') as fd:
+    json.dump({'VERSION': SNAPSHOT_VERSION, 'STAMP': stamp, 'RULES': rules}, fd, separators=(',', ':'))
+    fd.flush()
+    os.fsync(fd.fileno())
+  os.chmod(tmp, 0o644)
+  os.rename(tmp, FILE)
+  return rules
+
+
+def load_snapshot(stamp, FILE=None):
+  """
+  It loads the rule set saved by write_snapshot(). Returns None if snapshot
+  is missing, broken, has other version or was built from other config
+  files than 'stamp' describes (i.e. it's stale).
+  """
+  if FILE is None: FILE = SNAPSHOT_FILE
+  try:
+    with open(FILE, 'r') as fd:
+      snapshot = json.load(fd)
+    if snapshot['VERSION'] != SNAPSHOT_VERSION:
+      return None
+    if tuple(tuple(s) for s in snapshot['STAMP']) != stamp:
+      return None
+    return freeze_rules(snapshot['RULES'])
+  except:
+    return None
+
+
+def rule_set():
+  """
+  Returns the compiled rule set (see compile_rules()). It's cached for the
+  lifetime of the module and rebuilt only if some config file was changed,
+  added or removed. Snapshot written by 'pam-accesscontrol compile' is
+  preferred; config files are parsed only if it's missing or stale.
+  """
+  with stage('config'):
+    files = config_files()
+    stamp = config_stamp(files)
+    if rules_cache['stamp'] != stamp:
+      rules = load_snapshot(stamp)
+      if rules is None:
+        with stage('parse'):
+          rules = compile_rules(configuration(files))
+        if rules['DEBUG']: debug("no valid rule snapshot, config files parsed")
+      rules_cache['rules'] = rules
+      rules_cache['stamp'] = stamp
+  return rules_cache['rules']
+
+
+def settings():
+  """
+  'NAME:VALUE' lines of the rule set; if pam-accesscontrold has made the
+  decision, they are taken from its answer (see daemon_allow()).
+  """
+  if call_cache['settings'] is not None and rules_cache['rules'] is None:
+    return call_cache['settings']
+  return rule_set()['SETTINGS']
+
+
+def setting(name, default):
+  """
+  It returns value of 'NAME:VALUE' config line, converted to the type of
+  'default'. Broken or not defined values are interpreted as 'default'.
+  """
+  value = settings().get(name, None)
+  if value is None:
+    return default
+  try:
+    return type(default)(value)
+  except ValueError:
+    error("wrong value of '%s': %s, using %s", name, value, default)
+    return default
+
+
 def get_default():
   """
-  It reads the config file, parse it and tries to find 'DEFAULT' and
-  'DEBUG' values.
+  It returns 'DEFAULT' and 'DEBUG' values of the rule set.
 
   DEFAULT:
   This value will be interpreted as a default behavior for the NOT defined
@@ -132,53 +926,87 @@ def get_default():
   events will be logged. Default = True will turn ALL events on. Make sence
   for debugging, but can be confused for users/admins.
   """
-  DEBUG   = False
-  DEFAULT = 'CLOSE'
+  rules = rule_set()
+  DEFAULT = rules['DEFAULT']
+  DEBUG   = log_level() == LOG_LEVELS['DEBUG']
 
-  for line in configuration():
-    line = line.upper()
-    if line[:8] == "DEFAULT:":
-      if line.split(":")[1] in ['CLOSE', 'OPEN']:
-        #log("default access rule: " + line.split(":")[1])
-        DEFAULT = line.split(":")[1]
-      else:
-        log("default: CLOSE")
+  if DEBUG: debug("default access rule: " + DEFAULT)
+  return DEFAULT, DEBUG
 
-    if line[:6] == "DEBUG:":  DEBUG = line.split(":")[1]
 
-  if DEBUG == 'TRUE': DEBUG = True
-  else:               DEBUG = False
+def config_parser(SERVICE, DEBUG):
+  """
+  It returns the LIST of the correctly defined rules for SERVICE.
+  Broken rules are already ignored by compile_rules() (for security reason).
+  """
+  rules = list(rule_set()['SERVICES'].get(SERVICE.upper(), ()))
+  if DEBUG:
+    for rule in rules:
+      debug("rule: %s", rule)
+  return rules
 
-  if DEBUG: log("default access rule: " + DEFAULT)
-  return DEFAULT, DEBUG
+
+def users_from_logind():
+  """
+  Session source: it reads logind state files /run/systemd/users/<UID>.
+  Returns LIST of logged users, user is listed once for each its session.
+  """
+  USERS = []
+  for uid in os.listdir(LOGIND_USERS):
+    name, sessions = None, 1
+    try:
+      with open(LOGIND_USERS + uid, 'r') as fd:
+        for line in fd:
+          if line[:5] == "NAME=":     name = line[5:].strip()
+          if line[:9] == "SESSIONS=": sessions = max(1, len(line[9:].split()))
+    except (OSError, IOError):
+      pass # user logged out just now
+    if name: USERS = USERS + [name] * sessions
+  return USERS
 
 
-def config_parser(SERVICE, DEBUG):
+def users_from_loginctl():
   """
-  It reads and parses the config file and returns the LIST of the correctly
-  defined rules. Broken rules will be just ignored (for security reason).
+  Session source: it asks loginctl(1). Returns LIST of logged users, user
+  is listed once for each its session.
   """
-  rules = []
-  for rule in [c for c in configuration() if len(c) > 5]:
-    if DEBUG: log("rule: " + str(rule))
-    dic = {}
-    if len(rule.split(" ")) != 4:
-      if DEBUG: log("broken rule, wrong number of options... skipping: " +str(rule))
+  import subprocess as sp
+  out = sp.Popen(["/bin/loginctl", "list-sessions", "--no-legend"], stdin=sp.PIPE, stdout=sp.PIPE,
+                 stderr=sp.PIPE, universal_newlines=True).communicate()[0]
+  return [line.split()[2] for line in out.split("\n") if len(line.split()) > 2]
 
-    elif rule.split(" ")[0] != SERVICE.upper():
-      if DEBUG: log("other service... skipping: " + str(rule))
 
-    elif rule.split(" ")[1] not in ['OPEN', 'CLOSE', 'ASK','NUMBER']:
-      if DEBUG: log("second parameter is broken: " +str(rule))
+def fake_session_source(USERS):
+  """
+  Session source with a fixed LIST of logged users (for testing).
+  Use it like: session_sources['fake'] = fake_session_source(['bob', 'tom'])
+  and 'SESSION-SOURCE:fake' in config file.
+  """
+  return lambda: list(USERS)
 
-    elif rule.split(" ")[2] not in ['USER', 'GROUP']:
-      if DEBUG: log("third parameter is broken: " +str(rule))
 
-    else:
-      dic['OPTION'] = str(rule.split(" ")[1] + " " + rule.split(" ")[2])
-      dic['LIST'] = ids(rule.split(" ")[3])
-      rules.append(dic)
-  return rules
+# SESSION-SOURCE:<name> setting selects one of them;
+# by default logind files are used if they are there, loginctl if not.
+session_sources = {'logind': users_from_logind, 'loginctl': users_from_loginctl}
+
+
+def logged_users(DEBUG):
+  """
+  It returns LIST of already logged users (user is listed once for each
+  its session). Session source is asked only once per PAM call.
+  """
+  if call_cache['users'] is None:
+    source = setting('SESSION-SOURCE', '')
+    if source not in session_sources:
+      if source: error("unknown SESSION-SOURCE '%s'", source)
+      source = 'logind' if os.path.isdir(LOGIND_USERS) else 'loginctl'
+    try:
+      call_cache['users'] = session_sources[source]()
+    except Exception as e:
+      error("can't get list of logged users (%s): %s", source, e)
+      call_cache['users'] = []
+    if DEBUG: debug("USERS list (" + source + "): " + str(call_cache['users']))
+  return call_cache['users']
 
 
 def number_of_logged_already(login, group, DEBUG):
@@ -190,157 +1018,968 @@ def number_of_logged_already(login, group, DEBUG):
   after creating this new session.
   """
   item = 0
-  USERS = []
-  users_in_system = sp.Popen(["/bin/loginctl", "list-users"],stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE).communicate()[0].split("\n")
-  for users in users_in_system[1:-3]:
-    USERS.append([user for user in users.split(" ") if len(user)>0][-1])
-
-  if DEBUG: log("USERS list: " + str(USERS))
-  USERS.append(login)
-  USERS = dict(zip(USERS, USERS)).values() #delete same users: bob,tom,tom,tom => bob,tom
-  if DEBUG: log("USERS list after compression: " + str(USERS))
+  USERS = set(logged_users(DEBUG)) #delete same users: bob,tom,tom,tom => bob,tom
+  USERS.add(login)
+  if DEBUG: debug("USERS list after compression: " + str(sorted(USERS)))
 
   for U in USERS:
-    if U in check_users_group_list(group, login, DEBUG):
+    if U in check_users_group_list(group, U, DEBUG):
       item = item+1
-  if DEBUG: log("number of users (group '" + str(group) + "') after new connection: " + str(item))
+  if DEBUG: debug("number of users (group '" + str(group) + "') after new connection: " + str(item))
   return item
 
 
+def make_dir(path, mode):
+  """
+  It creates directory 'path' (with parents), if it's not there yet. Other
+  processes could create it at the same time.
+  """
+  try:
+    os.makedirs(path, mode)
+  except OSError as e:
+    if e.errno != errno.EEXIST or not os.path.isdir(path):
+      raise
+
+
+@contextlib.contextmanager
+def locked_state(FILE):
+  """
+  Shared state of all pam-accesscontrol processes: JSON dictonary in FILE.
+  It's locked (flock) while used and saved (atomically) at the end:
+
+    with locked_state(FILE) as state:
+      state['key'] = value
+  """
+  make_dir(os.path.dirname(FILE), 0o755)
+
+  with open(FILE + ".lock", 'a') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+      with open(FILE, 'r') as fd:
+        state = json.load(fd)
+    except (OSError, IOError, ValueError):
+      state = {}
+
+    yield state
+
+    tmp = FILE + ".tmp." + str(os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+      f.write(json.dumps(state, separators=(',', ':')))
+    os.rename(tmp, FILE)
+
+
+def number_groups():
+  """
+  Set of all groups used in NUMBER rules (of all services).
+  """
+  groups = set()
+  for service in rule_set()['INDEX'].values():
+    for L in service['NUMBER']:
+      groups.add(L.split(":")[0])
+  return groups
+
+
+def session_counter(state, DEBUG):
+  """
+  It prepares the state of session counter (see locked_state()):
+
+  users  - login => {'sessions': number of open sessions, 'reserved': time}
+  groups - group => {login: 1}, logged (or reserved) users of NUMBER group
+
+  First time (after reboot) it's filled with users logged already.
+  """
+  if 'users' not in state:
+    state['users'] = {}
+    state['groups'] = {}
+    for U in logged_users(DEBUG):
+      state['users'].setdefault(U, {'sessions': 0, 'reserved': 0})['sessions'] += 1
+    for U in state['users']:
+      for G in number_groups():
+        if U in check_users_group_list(G, U, DEBUG):
+          state['groups'].setdefault(G, {})[U] = 1
+    if DEBUG: debug("session counter is created for users: " + str(sorted(state['users'])))
+  return state
+
+
+def forget_user(state, login):
+  """
+  It removes user without sessions and without valid reservation.
+  """
+  user = state['users'].get(login, {'sessions': 0, 'reserved': 0})
+  if user['sessions'] <= 0 and time.time() - user['reserved'] > setting('NUMBER-RESERVATION', 300):
+    state['users'].pop(login, None)
+    for G in state['groups']:
+      state['groups'][G].pop(login, None)
+    return True
+  return False
+
+
+def recount_group(state, group, DEBUG):
+  """
+  Counted sessions could be never closed (killed sshd, failed PAM module
+  after this one): members of the NUMBER group without logged session (see
+  logged_users()) and without registered session of running process (see
+  session_opened()) are removed, if their reservation is expired.
+  """
+  logged = set(logged_users(DEBUG))
+  for U in list(state['groups'].get(group, {})):
+    if U in logged or registered(U):
+      continue
+    user = state['users'].get(U)
+    if user is not None and user['sessions'] > 0:
+      if DEBUG: debug("sessions of '" + str(U) + "' are not there anymore: " + str(user['sessions']))
+      user['sessions'] = 0
+    if user is None or forget_user(state, U):
+      state['groups'][group].pop(U, None)
+
+
+def registered(login):
+  """
+  Has 'login' registered session of running process (see session_opened())?
+  """
+  path = STATE_DIR + "registry/"
+  prefix = state_name(str(login) + "@")
+  try:
+    for who in os.listdir(path):
+      if who.startswith(prefix):
+        for name in os.listdir(path + who):
+          if process_alive(name.split("-")[0]):
+            return True
+  except OSError:
+    pass
+  return False
+
+
+def reserve_number(login, limits, DEBUG, reserve=True):
+  """
+  It checks limits of NUMBER groups ('limits' => LIST of (group, number))
+  and reserves place for 'login' in all its NUMBER groups, if at least one
+  of them has free place. Check and reservation are atomic. Without
+  'reserve' limits are only checked.
+  """
+  with locked_state(STATE_DIR + "sessions.json") as state:
+    session_counter(state, DEBUG)
+    allow = []
+    for group, number in limits:
+      users = state['groups'].setdefault(group, {})
+      for U in list(users):
+        if U != login: forget_user(state, U)
+      if login not in users and len(users) + 1 > number:
+        recount_group(state, group, DEBUG)
+
+      if login in users or len(users) + 1 <= number:
+        if DEBUG: debug("free place for group " + str(group))
+        allow.append(True)
+      else:
+        if DEBUG: debug("no more users allowed for group '" + str(group) + "'")
+        allow.append(False)
+
+    if any(allow) and reserve:
+      state['users'].setdefault(login, {'sessions': 0, 'reserved': 0})['reserved'] = time.time()
+      for group, number in limits:
+        state['groups'][group][login] = 1
+  return any(allow)
+
+
+@timed('sessions')
+def release_number(login, DEBUG):
+  """
+  It releases place reserved by reserve_number() for refused login, so
+  other users of the group don't have to wait for NUMBER-RESERVATION.
+  """
+  try:
+    with locked_state(STATE_DIR + "sessions.json") as state:
+      if 'users' in state and login in state['users']:
+        state['users'][login]['reserved'] = 0
+        if forget_user(state, login) and DEBUG:
+          debug("reservation of '" + str(login) + "' is released")
+  except (OSError, IOError) as e:
+    error("can't update session counter: %s", e)
+
+
+def session_key(handle):
+  """
+  File name of PAM 'handle' of this process in the session registry (see
+  session_opened()): PAM handles of different processes could be the same,
+  and the PID tells if the session is still there (see prune_registry()).
+  """
+  return state_name(str(os.getpid()) + "-" + str(handle))
+
+
+def state_name(name):
+  """
+  It escapes 'name' (user@host, PAM handle) to be used as a file name.
+  """
+  return re.sub(r"[^A-Za-z0-9@._:-]", lambda m: "%%%02X" % ord(m.group(0)), str(name))
+
+
+def write_state_file(FILE, data=b""):
+  """
+  It writes small file of one session (see session_opened()); its directory
+  is created if needed.
+  """
+  try:
+    fd = os.open(FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    make_dir(os.path.dirname(FILE), 0o700)
+    fd = os.open(FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+  try:
+    os.write(fd, data)
+  finally:
+    os.close(fd)
+
+
+def process_alive(pid):
+  try:
+    os.kill(int(pid), 0)
+    return True
+  except ValueError:
+    return False
+  except OSError as e:
+    return e.errno == errno.EPERM
+
+
+@timed('sessions')
+def mark_password_auth(handle):
+  """
+  It marks PAM handle of sshd session authenticated by password: sshd calls
+  'auth' only for password authentication, so sessions without the mark are
+  'sshd-key' sessions. Marks (empty files in STATE_DIR/auth/) of never opened
+  sessions are removed after an hour.
+  The mark is named by the handle only: sshd calls pam_authenticate() of
+  keyboard-interactive logins in other process than pam_open_session().
+  """
+  path = STATE_DIR + "auth/"
+  try:
+    write_state_file(path + state_name(handle))
+    now = time.time()
+    for name in os.listdir(path):
+      try:
+        if now - os.stat(path + name).st_mtime > 3600:
+          os.unlink(path + name)
+      except OSError:
+        pass
+  except (OSError, IOError) as e:
+    error("can't mark authentication: %s", e)
+
+
+@timed('sessions')
+def password_auth(handle):
+  """
+  It checks (and removes) the mark of mark_password_auth().
+  """
+  try:
+    os.unlink(STATE_DIR + "auth/" + state_name(handle))
+    return True
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      error("can't check authentication: %s", e)
+    return False
+
+
+@timed('sessions')
+def session_opened(login, DEBUG, handle=None, SERVICE=None, rhost=None, mode=None):
+  """
+  It counts new session of 'login' in all its NUMBER groups. If PAM 'handle'
+  is known, the session is also registered (service, user@host, rule): one
+  file per session in STATE_DIR/registry/<user@host>/ (see session_closed()).
+  """
+  try:
+    with locked_state(STATE_DIR + "sessions.json") as state:
+      session_counter(state, DEBUG)
+      user = state['users'].setdefault(login, {'sessions': 0, 'reserved': 0})
+      user['sessions'] += 1
+      user['reserved'] = 0
+      groups = call_cache['number_groups']
+      if groups is None:
+        groups = [G for G in number_groups() if login in check_users_group_list(G, login, DEBUG)]
+      for G in groups:
+        state['groups'].setdefault(G, {})[login] = 1
+  except (OSError, IOError) as e:
+    error("can't update session counter: %s", e)
+
+  if handle is not None:
+    who = str(login) + "@" + str(rhost)
+    try:
+      write_state_file(STATE_DIR + "registry/" + state_name(who) + "/" + session_key(handle),
+                       json.dumps({'SERVICE': SERVICE, 'WHO': who, 'MODE': mode}).encode())
+      prune_registry()
+    except (OSError, IOError) as e:
+      error("can't register session: %s", e)
+
+
+def prune_registry():
+  """
+  Once an hour it removes registered sessions of processes which are gone
+  without closing of the session (killed sshd and so on).
+  """
+  stamp = STATE_DIR + "registry.pruned"
+  try:
+    if time.time() - os.stat(stamp).st_mtime < 3600:
+      return
+  except OSError:
+    pass
+  write_state_file(stamp)
+
+  path = STATE_DIR + "registry/"
+  for who in os.listdir(path):
+    for name in os.listdir(path + who):
+      if not process_alive(name.split("-")[0]):
+        try:
+          os.unlink(path + who + "/" + name)
+        except OSError:
+          pass
+    try:
+      os.rmdir(path + who)
+    except OSError:
+      pass   # not empty
+
+
+@timed('sessions')
+def session_closed(login, DEBUG, handle=None, rhost=None):
+  """
+  It removes closed session of 'login' from the session counter. Returns
+  the registry entry of the session (see session_opened()) with number of
+  other sessions of the same user@host ('LEFT'); None if the session is not
+  registered.
+  """
+  try:
+    with locked_state(STATE_DIR + "sessions.json") as state:
+      if 'users' in state and login in state['users']:
+        state['users'][login]['sessions'] -= 1
+        if forget_user(state, login) and DEBUG:
+          debug("last session of '" + str(login) + "' is closed")
+  except (OSError, IOError) as e:
+    error("can't update session counter: %s", e)
+
+  if handle is None:
+    return None
+  path = STATE_DIR + "registry/" + state_name(str(login) + "@" + str(rhost)) + "/"
+  try:
+    with open(path + session_key(handle), 'r') as fd:
+      entry = json.load(fd)
+    os.unlink(path + session_key(handle))
+    entry['LEFT'] = len([name for name in os.listdir(path) if process_alive(name.split("-")[0])])
+    return entry
+  except (OSError, IOError, ValueError) as e:
+    if getattr(e, 'errno', None) != errno.ENOENT:
+      error("can't read registered session: %s", e)
+    return None
+
+
+@timed('sessions')
 def check_number_in_group(login, LIST, DEBUG):
   """
   It checks LIST of NUMBER rule to make a decision about creating new session.
+  Place for the user is reserved by session counter (see reserve_number()),
+  only if call_cache['reserve'] is set (session is opened by this call);
+  if it's not available, logged users are counted.
   """
-  allow = []
+  limits = []
   for L in LIST:
     if len(L.split(":")) != 2:
-      if DEBUG: log("wrong defined rule NUMBER '" + str(L) + "'... skipping")
+      if DEBUG: debug("wrong defined rule NUMBER '" + str(L) + "'... skipping")
     else:
       if login in check_users_group_list(L.split(":")[0], login, DEBUG):
         try:
-          if int(L.split(":")[1]) < int(number_of_logged_already(login, L.split(":")[0], DEBUG)):
-            if DEBUG: log("no more users allowed for group '" + str(L.split(":")[0]) + "'")
-            allow.append(False)
-
-          else:
-            if DEBUG: log("free place for group " +str(L.split(":")[0]))
-            allow.append(True)
-        except:
-          if DEBUG: log("wrong defined rule NUMBER '" + str(L) + "'. This value should be an integer... skipping")
+          limits.append((L.split(":")[0], int(L.split(":")[1])))
+        except ValueError:
+          if DEBUG: debug("wrong defined rule NUMBER '" + str(L) + "'. This value should be an integer... skipping")
       else:
-        if DEBUG: log("user '" + str(login) + "' is not in group '" + L.split(":")[0] + "'")
+        if DEBUG: debug("user '" + str(login) + "' is not in group '" + L.split(":")[0] + "'")
 
-  if len(allow) == 0:
-    if DEBUG: log("all NUMBER rules have nothing to do with user '" + str(login) + "'")
+  if len(limits) == 0:
+    if DEBUG: debug("all NUMBER rules have nothing to do with user '" + str(login) + "'")
     return True
 
-  if any(allow): return True
-  else:          return False
+  try:
+    return reserve_number(login, limits, DEBUG, call_cache['reserve'])
+  except (OSError, IOError) as e:
+    error("can't use session counter: %s", e)
+
+  for group, number in limits:
+    if number >= number_of_logged_already(login, group, DEBUG):
+      if DEBUG: debug("free place for group " + str(group))
+      return True
+    if DEBUG: debug("no more users allowed for group '" + str(group) + "'")
+  return False
+
+
+def number_rules(SERVICE):
+  """
+  LIST of NUMBER rules of SERVICE.
+  """
+  index = rule_set()['INDEX'].get(SERVICE.upper())
+  if index is None:
+    return []
+  return list(index['NUMBER'])
 
 
 def check_users_group_list(group, login, DEBUG):
   """
-  This function tries to call glibc to get the list of user's groups.
-  Theoretically, it should support local host groups, LDAP groups and sssd+LDAP (freeIPA, AD).
+  It checks is 'login' a member of 'group'. Group 'ALL' means everyone.
   Type of the return value should be a LIST; empty LIST is authorized.
   """
   if group == "ALL":
-    if DEBUG: log("okay, group 'ALL' means everyone")
+    if DEBUG: debug("okay, group 'ALL' means everyone")
     return [str(login)]
 
-  getgrouplist = cdll.LoadLibrary(find_library('libc')).getgrouplist
+  if group in user_groups(login, DEBUG):
+    if DEBUG: debug("user '" + str(login) + "' is a member of group '" + str(group) + "'")
+    return [str(login)]
+  return []
 
-  ngroups = 30
-  getgrouplist.argtypes = [c_char_p, c_uint, POINTER(c_uint * ngroups), POINTER(c_int)]
-  getgrouplist.restype = c_int32
 
+def user_groups(login, DEBUG):
+  """
+  It returns set of names of all user's groups (empty set for unknown user).
+  Groups are looked up only once per PAM call. If 'GROUP-CACHE-TTL:<seconds>'
+  is set, groups are also kept in the on-disk cache (see cached_groups()).
+  """
+  if login in call_cache['groups']:
+    return call_cache['groups'][login]
+
+  ttl = setting('GROUP-CACHE-TTL', 0)
+  with stage('groups'):
+    if ttl > 0:
+      groups = cached_groups(login, ttl, DEBUG)
+    else:
+      groups = lookup_groups(login, {}, 0)
+      if groups is None:
+        if DEBUG: debug("unknown user '" + str(login) + "'")
+        groups = frozenset()
+
+  call_cache['groups'][login] = groups
+  return groups
+
+
+def cached_groups(login, ttl, DEBUG):
+  """
+  Groups from the cache are fresh for GROUP-CACHE-TTL seconds. After that,
+  during GROUP-CACHE-STALE seconds, they are still used, but refreshed in
+  background, so slow LDAP/sssd doesn't block the login. Unknown users are
+  cached for GROUP-CACHE-NEGATIVE-TTL seconds.
+  """
+  stale    = setting('GROUP-CACHE-STALE', 0)
+  negative = setting('GROUP-CACHE-NEGATIVE-TTL', 60)
+  cache    = load_groups_cache()
+  entry    = cache['users'].get(login)
+
+  if entry is not None:
+    age = time.time() - entry[0]
+    if entry[1] is None and age < negative:
+      groups_cache_stats['negative'] += 1
+      groups = frozenset()
+    elif entry[1] is not None and age < ttl:
+      groups_cache_stats['hit'] += 1
+      groups = frozenset(entry[1])
+    elif entry[1] is not None and age < ttl + stale:
+      groups_cache_stats['stale'] += 1
+      groups = frozenset(entry[1])
+      refresh_groups(login, ttl, DEBUG)
+    else:
+      entry = None
+
+  if entry is None:
+    groups_cache_stats['miss'] += 1
+    gids = {}
+    groups = lookup_groups(login, gids, ttl)
+    save_groups_cache(login, groups, gids)
+    if groups is None: groups = frozenset()
+
+  if DEBUG: debug("group cache: " + " ".join(k + "=" + str(v) for k, v in sorted(groups_cache_stats.items())))
+  return groups
+
+
+def refresh_groups(login, ttl, DEBUG):
+  """
+  It looks up user's groups in background and updates the cache.
+  """
+  if login in groups_refresh:
+    return
+
+  def refresh():
+    try:
+      gids = {}
+      if not save_groups_cache(login, lookup_groups(login, gids, ttl), gids) and DEBUG:
+        debug("groups of user '" + str(login) + "' are not found, last known groups are kept")
+    except Exception as e:
+      if DEBUG: debug("can't refresh groups of user '" + str(login) + "': " + str(e))
+    groups_refresh.discard(login)
+
+  import threading
+  groups_refresh.add(login)
+  thread = threading.Thread(target=refresh)
+  thread.daemon = True
+  thread.start()
+
+
+def load_groups_cache():
+  """
+  It returns content of GROUP_CACHE_FILE. The file is read again only if
+  it was changed (by this or by other process).
+  """
+  try:
+    st = os.stat(GROUP_CACHE_FILE)
+    stamp = (st.st_ino, st.st_mtime, st.st_size)
+  except OSError:
+    return groups_cache
+
+  if groups_cache['stamp'] != stamp:
+    try:
+      with open(GROUP_CACHE_FILE, 'r') as fd:
+        data = json.load(fd)
+      groups_cache['users'] = data['users']
+      groups_cache['gids'] = data['gids']
+    except:
+      error("can't read group cache %s", GROUP_CACHE_FILE)
+    groups_cache['stamp'] = stamp
+  return groups_cache
+
+
+def save_groups_cache(login, groups, gids):
+  """
+  It adds user's groups (None for unknown user) and names of looked up gids
+  to the GROUP_CACHE_FILE. The file is limited to GROUP-CACHE-SIZE users;
+  oldest entries are removed first.
+  Known groups are never replaced by None: getpwnam() fails the same way for
+  unknown user and for NSS outage, so the last known groups (and their time)
+  are kept. Returns False if the entry is not changed because of it.
+  """
+  size = setting('GROUP-CACHE-SIZE', 1000)
+  now = time.time()
+  try:
+    make_dir(os.path.dirname(GROUP_CACHE_FILE), 0o700)
+
+    with open(GROUP_CACHE_FILE + ".lock", 'a') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      cache = load_groups_cache()
+      if groups is None and cache['users'].get(login, [0, None])[1] is not None:
+        return False
+      users = dict(cache['users'])
+      users[login] = [now, sorted(groups) if groups is not None else None]
+      if len(users) > size:
+        users = dict(sorted(users.items(), key=lambda u: u[1][0])[-size:])
+
+      names = dict(cache['gids'])
+      for gid in gids:
+        names[str(gid)] = [now, gids[gid]]
+
+      tmp = GROUP_CACHE_FILE + ".tmp." + str(os.getpid())
+      fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      with os.fdopen(fd, 'w') as f:
+        f.write(json.dumps({'users': users, 'gids': names}, separators=(',', ':')))
+      os.rename(tmp, GROUP_CACHE_FILE)
+  except (OSError, IOError) as e:
+    error("can't write group cache %s: %s", GROUP_CACHE_FILE, e)
+  return True
+
+
+def user_gids(user):
+  """
+  It returns GIDs of all groups of the user (getgrouplist(3)): by
+  os.getgrouplist() of Python 3 or by glibc, loaded by ctypes once per
+  process for Python 2. libc is already loaded into every PAM process, so
+  symbols of the process are used; find_library() runs ldconfig/gcc and is
+  the last resort only.
+  """
+  if hasattr(os, 'getgrouplist'):
+    return os.getgrouplist(user.pw_name, user.pw_gid)
+
+  global getgrouplist
+  from ctypes import CDLL, cdll, c_char_p, c_uint, c_int, c_int32, POINTER, byref
+  if getgrouplist is None:
+    try:
+      function = CDLL(None).getgrouplist
+    except AttributeError:
+      from ctypes.util import find_library
+      function = cdll.LoadLibrary(find_library('c')).getgrouplist
+    function.argtypes = [c_char_p, c_uint, POINTER(c_uint), POINTER(c_int)]
+    function.restype = c_int32
+    getgrouplist = function
+
+  name = user.pw_name
+  if not isinstance(name, bytes): name = name.encode()
+
+  ngroups = 30
   grouplist = (c_uint * ngroups)()
   ngrouplist = c_int(ngroups)
-
-  user = pwd.getpwnam(login)
-  ct = getgrouplist(user.pw_name, user.pw_gid, byref(grouplist), byref(ngrouplist))
+  ct = getgrouplist(name, user.pw_gid, grouplist, byref(ngrouplist))
 
   # if 30 groups was not enought this will be -1, try again
   # luckily the last call put the correct number of groups in ngrouplist
   if ct < 0:
-    getgrouplist.argtypes = [c_char_p, c_uint, POINTER(c_uint *int(ngrouplist.value)), POINTER(c_int)]
     grouplist = (c_uint * int(ngrouplist.value))()
-    ct = getgrouplist(user.pw_name, user.pw_gid, byref(grouplist), byref(ngrouplist))
+    ct = getgrouplist(name, user.pw_gid, grouplist, byref(ngrouplist))
+  return [grouplist[i] for i in range(0, ct)]
 
-  for i in xrange(0, ct):
-    gid = grouplist[i]
-    if (group == grp.getgrgid(gid).gr_name):
-      if DEBUG: log("user '" + str(login) + "' is a member of group '" + str(group) + "'")
-      return [str(login)]
-  return []
+
+def lookup_groups(login, gids, ttl):
+  """
+  This function tries to call glibc to get the list of user's groups.
+  Theoretically, it should support local host groups, LDAP groups and sssd+LDAP (freeIPA, AD).
+  Returns None if there is no such user. Names of gids, which are not in the
+  group cache (or older than 'ttl'), are added to 'gids'.
+  """
+  try:
+    user = pwd.getpwnam(login)
+  except KeyError:
+    return None
+
+  now = time.time()
+  names = groups_cache['gids']
+  groups = set()
+  for gid in user_gids(user):
+    if ttl > 0 and str(gid) in names and now - names[str(gid)][0] < ttl:
+      groups.add(names[str(gid)][1])
+      continue
+    try:
+      gids[gid] = grp.getgrgid(gid).gr_name
+      groups.add(gids[gid])
+    except KeyError:
+      pass # GID without name
+  return frozenset(groups)
 
 
+@timed('dialog')
 def dialog(DEBUG, rhost, user, flavor, SERVICE):
   """
   This calls UserInterface to get confirmations about creating new session.
   It also notified user about session termination.
   """
-  return sp.Popen(["/usr/share/pam-accesscontrol/notifications.py",
+  import subprocess as sp
+  return sp.Popen([NOTIFICATIONS,
       str(DEBUG), str(rhost), str(user), flavor, SERVICE], stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE).communicate()[0]
 
 
-def check(access, i, rules, login, DEBUG):
+@timed('dialog')
+def ask(DEBUG, rhost, user, SERVICE):
   """
-  It gets list of rules, parses it and fills the 'access' dictonary with 4
-  lists: CLOSE, ASK, OPEN and NUMBER.
+  ASK broker: it returns answer of X-session owner (0 - yes, 1 - no).
+  Concurrent requests of the same user@host for the same service share one
+  window: the first one (holding the lock) shows it and saves the answer,
+  others are waiting for the lock and take the saved answer. Nobody waits
+  longer than ASK-TIMEOUT seconds (default 120, 0 - no limit); the answer
+  is ASK-TIMEOUT-DEFAULT (OPEN or CLOSE, default CLOSE) then. Waiting
+  logins don't start any process.
   """
-  for r in rules:
-    if DEBUG: log("rules: "+ str(r))
-    if i['OPTION'].split(" ")[0] == r: #OPEN, ASK, CLOSE, NUMBER
-      if DEBUG: log("that was interpreted as " + r +": "+ str(i['OPTION'].split(" ")[0]))
+  timeout = setting('ASK-TIMEOUT', 120.0)
+  default = 0 if setting('ASK-TIMEOUT-DEFAULT', 'CLOSE').upper() == "OPEN" else 1
+  name = STATE_DIR + "ask/" + re.sub("[^A-Za-z0-9_.:@-]", "_", str(user) + "@" + str(rhost) + "-" + SERVICE)
+  start = time.time()
+  expired = lambda: timeout > 0 and time.time() - start > timeout
 
-      if i['OPTION'].split(" ")[1] == "USER":
-        if DEBUG: log("I'm going to look at USERS list: " +str(i['OPTION'].split(" ")[1]))
-        access[r] = access[r] + i['LIST']
- 
-      elif i['OPTION'].split(" ")[1] == "GROUP":
-        if i['OPTION'].split(" ")[0] == "NUMBER":
-          if DEBUG: log("I'm going to look at NUMBER of USERS in GROUP: " +str(i['OPTION'].split(" ")[1]))
-          access[r] = access[r] + i['LIST']
-        else:
-          if DEBUG: log("I'm going to look at GROUP list: " +str(i['OPTION'].split(" ")[1]))
-          for group in i['LIST']:
-            access[r] = access[r] + check_users_group_list(group, login, DEBUG)
-  return access
+  make_dir(STATE_DIR + "ask/", 0o700)
+
+  with open(name + ".lock", 'a') as lock:
+    while True:
+      try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        break
+      except (IOError, OSError):
+        if expired():
+          debug("no answer in %s seconds (other window), using ASK-TIMEOUT-DEFAULT", timeout)
+          return default
+        time.sleep(0.1)
+
+    # answer given while we were waiting for the lock
+    try:
+      with open(name + ".answer", 'r') as fd:
+        saved = json.load(fd)
+      if saved['STAMP'] >= start:
+        if DEBUG: debug("answer of the shared window: " + str(saved['ANSWER']))
+        return saved['ANSWER']
+    except (OSError, IOError, ValueError, KeyError):
+      pass
+
+    answer = ask_window(DEBUG, rhost, user, SERVICE, expired)
+    if answer is None:
+      debug("no answer in %s seconds, using ASK-TIMEOUT-DEFAULT", timeout)
+      answer = default
+
+    tmp = name + ".answer.tmp." + str(os.getpid())
+    with open(tmp, 'w') as fd:
+      json.dump({'STAMP': time.time(), 'ANSWER': answer}, fd)
+    os.rename(tmp, name + ".answer")
+  return answer
+
+
+def ask_window(DEBUG, rhost, user, SERVICE, expired):
+  """
+  It shows ASK window (see dialog()) and polls for the answer until
+  'expired()'. Returns 0 (yes), 1 (no) or None (timeout; the window is
+  closed).
+  """
+  import subprocess as sp
+  proc = sp.Popen([NOTIFICATIONS,
+      str(DEBUG), str(rhost), str(user), "ask", SERVICE], stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE,
+      preexec_fn=os.setsid)
+  while proc.poll() is None:
+    if expired():
+      try:
+        os.killpg(proc.pid, 15)
+      except OSError:
+        pass
+      proc.wait()
+      return None
+    time.sleep(0.1)
+
+  ret = proc.stdout.read()
+  if DEBUG: debug("[0->Yes; 1->No] RET = " + str(ret))
+  try:
+    return 0 if int(ret) == 0 else 1
+  except ValueError:
+    error("something goes wrong... no return value from notification window")
+    return 1
+
+
+def decide(index, login, groups):
+  """
+  It finds the rule for 'login' in the INDEX of service (see compile_rules()).
+  'groups' is a FUNCTION which returns set of user's groups; it's called only
+  if some group can change the decision. Only user's own groups are looked
+  at, not all groups of the rules. Returns 'CLOSE', 'ASK', 'OPEN' or None
+  (no rule for this user).
+  """
+  mode = index['USERS'].get(login)
+  rules = index['GROUPS']
+  if mode != "CLOSE" and "ALL" in rules:    # group 'ALL' means everyone
+    mode = higher(mode, rules['ALL'])
+
+  if mode != "CLOSE" and len(rules) > ("ALL" in rules):
+    for group in groups():
+      if group in rules: mode = higher(mode, rules[group])
+  return mode
+
+
+def higher(mode, other):
+  """
+  It returns the rule with higher PRIORITY (None - no rule).
+  """
+  if PRIORITY[other] > PRIORITY.get(mode, 0): return other
+  return mode
+
+
+def config_generation():
+  """
+  Generation of the config files: it's changed with every change of them
+  (see config_stamp()).
+  """
+  rule_set()
+  return "%08x" % (zlib.crc32(json.dumps(rules_cache['stamp']).encode()) & 0xffffffff)
+
+
+def cached_decision(SERVICE, host, login, ttl, DEBUG):
+  """
+  It returns decision saved by save_decision() during last 'ttl' seconds
+  for the same service, login, rhost and config generation (None if there
+  is no such decision). The cache is read without locking: it's replaced
+  atomically.
+  """
+  try:
+    with open(STATE_DIR + "decisions.json", 'r') as fd:
+      cache = json.load(fd)
+  except (OSError, IOError, ValueError):
+    return None
+
+  if cache.get('GENERATION') != config_generation():
+    return None
+  entry = cache.get('DECISIONS', {}).get("\t".join([SERVICE, str(host or ""), login]))
+  if entry is None or time.time() - entry[0] >= ttl:
+    return None
+
+  if DEBUG: debug("decision cache hit: " + str(entry[1]) + " (" + str(int(time.time() - entry[0])) + "s old)")
+  return str(entry[1])
+
+
+def save_decision(SERVICE, host, login, mode, ttl):
+  """
+  It saves decision (OPEN or CLOSE) in the decision cache. Decisions of old
+  config generation and expired decisions are removed.
+  """
+  now = time.time()
+  generation = config_generation()
+  try:
+    with locked_state(STATE_DIR + "decisions.json") as cache:
+      if cache.get('GENERATION') != generation:
+        cache['GENERATION'] = generation
+        cache['DECISIONS'] = {}
+      decisions = cache.setdefault('DECISIONS', {})
+      for key in [k for k in decisions if now - decisions[k][0] >= ttl]:
+        del decisions[key]
+      decisions["\t".join([SERVICE, str(host or ""), login])] = [now, mode]
+  except (OSError, IOError) as e:
+    error("can't save decision: %s", e)
+
+
+def index_mode(index, host, login, groups, DEBUG):
+  """
+  It finds the rule for 'login' connecting from 'host' in the index: rules
+  of USERS and GROUPS and of all networks (NET) containing 'host'. If 'host'
+  is not an IP address (hostname, see UseDNS in sshd_config(5)), networks
+  can't be checked: CLOSE rules of all networks are used, OPEN and ASK not.
+  """
+  mode = decide(index, login, groups)
+  if index['NET'] and mode != "CLOSE" and host and address(host) is None:
+    log("rhost '%s' is not an IP address, only CLOSE rules of NET/FROM are used", host)
+    for family in index['NET'].values():
+      for length, prefixes in family:
+        for rules in prefixes.values():
+          if decide(rules, login, groups) == "CLOSE":
+            return "CLOSE"
+
+  elif index['NET'] and mode != "CLOSE":
+    scopes = net_scopes(index['NET'], host)
+    if DEBUG: debug("rhost '" + str(host) + "' is in " + str(len(scopes)) + " network(s) of NET/FROM rules")
+    for rules in scopes:
+      net_mode = decide(rules, login, groups)
+      if net_mode is not None: mode = higher(mode, net_mode)
+  return mode
+
+
+def service_index(rules, SERVICE):
+  """
+  It returns the INDEX of SERVICE in the rule set (empty one for services
+  without rules).
+  """
+  return rules['INDEX'].get(SERVICE.upper(), {'USERS': {}, 'GROUPS': {}, 'NUMBER': (), 'NET': {}, 'TIME': []})
+
+
+def rules_mode(index, host, login, groups, DEBUG, now=None):
+  """
+  It finds the rule for 'login' connecting from 'host' in the INDEX of
+  service, TIME rules included if (local) time 'now' is in their schedule.
+  Nothing is changed or reserved (NUMBER is not checked), so it's also used
+  to simulate decisions (see 'pam-accesscontrol simulate').
+  """
+  mode = index_mode(index, host, login, groups, DEBUG)
+
+  if index['TIME'] and mode != "CLOSE":
+    now = now or time.localtime()
+    for timed in index['TIME']:
+      if in_schedule(timed['SCHEDULE'], now):
+        if DEBUG: debug("TIME rules are used: " + str(timed['SCHEDULE']))
+        timed_mode = index_mode(timed, host, login, groups, DEBUG)
+        if timed_mode is not None: mode = higher(mode, timed_mode)
+  return mode
+
+
+def service_mode(SERVICE, mode, DEFAULT):
+  """
+  Rule found for the user becomes access mode: DEFAULT if there is no rule,
+  ASK is possible only for SSH (there is nobody to ask otherwise).
+  """
+  if mode is None:                        return DEFAULT
+  if mode == "ASK" and SERVICE not in ["sshd", "sshd-key"]: return "CLOSE"
+  return mode
 
 
 def allow(SERVICE, host, login, DEFAULT, DEBUG):
-  access = {"OPEN":[], "ASK":[], "CLOSE":[], "NUMBER":[]}
-  ret = None
+  """
+  It returns access mode for 'login': the rule found in the precompiled
+  INDEX of SERVICE, DEFAULT if there is no rule for this user.
+  With 'DECISION-CACHE-TTL:<seconds>' OPEN and CLOSE decisions are reused
+  for repeated logins (see cached_decision()).
+  """
+  index = service_index(rule_set(), SERVICE)
 
-  for rule in config_parser(SERVICE, DEBUG):
-    if DEBUG:
-      log("----------------------------------------------")
-      log("rule = " +str(rule))
-    access.update(check(access, rule, ["OPEN", "ASK", "CLOSE", "NUMBER"], login, DEBUG))
+  # Decisions depending on NUMBER or TIME are never cached
+  ttl = setting('DECISION-CACHE-TTL', 0)
+  cacheable = ttl > 0 and not index['NUMBER'] and not index['TIME']
+  if cacheable:
+    mode = cached_decision(SERVICE, host, login, ttl, DEBUG)
+    if mode is not None:
+      return mode
+
+  mode = rules_mode(index, host, login, lambda: user_groups(login, DEBUG), DEBUG)
 
   if DEBUG:
-    log("----------------------------------------------")
-    log("OPEN for  : "+str(access['OPEN']))
-    log("CLOSE for : "+str(access['CLOSE']))
-    log("ASK for   : "+str(access['ASK']))
-    log("NUMBER for: "+str(access['NUMBER']))
-
-  if len(access['NUMBER']) > 0:
-    if not check_number_in_group(login, access['NUMBER'], DEBUG):
-      if DEBUG: log("'allow()' returns 'CLOSE', because of access[NUMBER]")
+    config_parser(SERVICE, DEBUG)
+    debug("----------------------------------------------")
+    debug("rule for '%s': %s (DEFAULT: %s)", login, mode, DEFAULT)
+    debug("NUMBER for: %s", list(index['NUMBER']))
+
+  mode = service_mode(SERVICE, mode, DEFAULT)
+
+  # NUMBER is checked (and the place is reserved) only if access is possible
+  if mode != "CLOSE" and len(index['NUMBER']) > 0:
+    if not check_number_in_group(login, list(index['NUMBER']), DEBUG):
+      if DEBUG: debug("'allow()' returns 'CLOSE', because of access[NUMBER]")
       return "CLOSE"
 
-  # Priority of CLOSE rule is higher than OPEN
-  for i in access['OPEN']:
-    if i in access['CLOSE']: access['OPEN'].remove(i)
+  if cacheable and mode in ["OPEN", "CLOSE"]:
+    save_decision(SERVICE, host, login, mode, ttl)
+  return mode
+
 
-  if login in access['CLOSE']:          return "CLOSE"
-  elif login in access['ASK']:
-    if SERVICE in ["sshd", "sshd-key"]: return "ASK"
-    else:                               return "CLOSE"
-  elif login in access['OPEN']:         return "OPEN"
-  else:                                 return DEFAULT
+@timed('daemon')
+def daemon_socket():
+  """
+  Path of the socket of pam-accesscontrold(8) or None if it's not running.
+  The default DAEMON_SOCKET is checked first, so the rule set is not
+  loaded if the daemon is there.
+  """
+  def root_socket(path):
+    try:
+      return bool(path) and os.stat(path).st_uid == 0
+    except OSError:
+      return False
+
+  if root_socket(DAEMON_SOCKET):
+    return DAEMON_SOCKET
+  path = setting('DAEMON-SOCKET', DAEMON_SOCKET)
+  if path != DAEMON_SOCKET and root_socket(path):
+    return path
+  return None
+
+
+def daemon_allow(SERVICE, host, login):
+  """
+  It asks pam-accesscontrold(8) to make the decision (like allow() does).
+  Returns None if the daemon is not running (or doesn't answer in time);
+  in this case allow() should be called by itself.
+
+  The answer contains also log level, settings and NUMBER groups of
+  the user, so the rule set is not loaded by this process at all.
+  """
+  path = daemon_socket()
+  if path is None:
+    return None
+
+  import socket
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.settimeout(setting('DAEMON-TIMEOUT', 1.0) if rules_cache['rules'] is not None else 1.0)
+  try:
+    sock.connect(path)
+    sock.sendall(json.dumps({'service': SERVICE, 'host': host, 'login': login,
+                             'reserve': call_cache['reserve']}).encode() + b"\n")
+    data = b""
+    while not data.endswith(b"\n"):
+      chunk = sock.recv(4096)
+      if not chunk: break
+      data = data + chunk
+    answer = json.loads(data.decode())
+    mode = str(answer['mode'])
+  except (socket.error, ValueError, KeyError, TypeError) as e:
+    error("pam-accesscontrold is not available (%s), checking rules by myself", e)
+    return None
+  finally:
+    sock.close()
+
+  if mode not in ["OPEN", "ASK", "CLOSE"]:
+    error("pam-accesscontrold returns '%s', checking rules by myself", mode)
+    return None
+  if isinstance(answer.get('settings'), dict):
+    call_cache['settings'] = answer['settings']
+  if isinstance(answer.get('number_groups'), list):
+    call_cache['number_groups'] = answer['number_groups']
+  if answer.get('level') in LOG_LEVELS.values():
+    set_log_level(answer['level'])
+  debug("pam-accesscontrold returns: %s", mode)
+  return mode
 
 
 def main(SERVICE, pamh, flags, argv):
@@ -350,120 +1989,140 @@ def main(SERVICE, pamh, flags, argv):
   its methods to define name of the remote host and user's name.
   """
 
-  DEFAULT, DEBUG = get_default()
-  log("DEBUG is set to " + str(DEBUG))
-
   try:
     user = pamh.get_user()
     rhost = pamh.rhost
-  except pamh.exception, e:
-    log("something goes wrong... no info about remote connection")
+  except pamh.exception as e:
+    error("something goes wrong... no info about remote connection")
     return e.pam_result
 
-  mode = allow(SERVICE, rhost, user, DEFAULT, DEBUG)
-  if DEBUG: log("main got from allow: "+str(mode))
+  mode = daemon_allow(SERVICE, rhost, user)
+  if mode is None:
+    DEFAULT, DEBUG = get_default()
+    mode = allow(SERVICE, rhost, user, DEFAULT, DEBUG)
+  DEBUG = log_level() == LOG_LEVELS['DEBUG']
+  if DEBUG: debug("DEBUG is set to True")
+  if DEBUG: debug("main got from allow: "+str(mode))
+  call_cache['mode'] = mode
 
   if mode == "ASK":
-    if DEBUG: log("SHOW ME WINDOW")
-    ret = str(dialog(DEBUG, rhost, user, "ask", SERVICE))
-    if DEBUG: log("[0->Yes; 1->No] RET = " + str(ret))
+    if DEBUG: debug("SHOW ME WINDOW")
     try:
-      if int(ret) == 0:
-        if allow(SERVICE, rhost, user, DEFAULT, False) == "ASK":
-          create_log(SERVICE, rhost, user, mode, "creating new session")
-          log("access granted")
-          return pamh.PAM_SUCCESS
-        else:
-          log("connection CAN NOT be established; because of NUMBER rule")
-          return pamh.PAM_AUTH_ERR
+      ret = ask(DEBUG, rhost, user, SERVICE)
+    except Exception as e:
+      error("something goes wrong... no return value from notification window: %s", e)
+      release_number(user, DEBUG)
+      return pamh.PAM_AUTH_ERR
+
+    if ret == 0:
+      if check_number_in_group(user, number_rules(SERVICE), False):
+        create_log(SERVICE, rhost, user, mode, "creating new session")
+        log("access granted (%s) from %s", mode, rhost)
+        return pamh.PAM_SUCCESS
       else:
-        log("connection SHOULD NOT be established; because of X-session owner's decision")
+        log("access denied (%s) from %s: connection CAN NOT be established; because of NUMBER rule", mode, rhost)
         return pamh.PAM_AUTH_ERR
-    except:
-      log("something goes wrong... no return value from notification window")
+    else:
+      # 'no' or no answer (ASK-TIMEOUT)
+      log("access denied (%s) from %s: connection SHOULD NOT be established; because of X-session owner's decision", mode, rhost)
+      release_number(user, DEBUG)
       return pamh.PAM_AUTH_ERR
 
   elif mode == "CLOSE":
     create_log(SERVICE, rhost, user, mode, "access denied")
-    log("access denied")
+    log("access denied (%s) from %s", mode, rhost)
     if str(pamh.service) in ["slim","sddm","lightdm","xdm","kdm"]:
       dialog(DEBUG, rhost, user, "xorg", SERVICE)
     return pamh.PAM_AUTH_ERR
 
   elif mode == "OPEN":
     create_log( SERVICE, rhost, user, mode, "access granted")
-    log("access granted")
+    log("access granted (%s) from %s", mode, rhost)
     return pamh.PAM_SUCCESS
 
   else:
-    log("I don't know what to do now... " +str(mode))
+    error("I don't know what to do now... %s", mode)
     return pamh.PAM_AUTH_ERR
 
 
+@instrumented("authenticate")
 def pam_sm_authenticate(pamh, flags, argv):
-  global log_prefix
-  log_prefix = "pam-accesscontrol(" + str(pamh.service) + ":" + str(pamh.get_user()) +"): "
+  new_call("pam-accesscontrol(" + str(pamh.service) + ":" + str(pamh.get_user()) +"): ", str(pamh.service))
 
-  log("==============================================")
-  log("authentication")
+  debug("==============================================")
+  debug("authentication")
 
   try:
-    log("remote user: "+ str(pamh.get_user()))
-    log("remote host: "+ str(pamh.rhost))
-  except pamh.exception, e:
-    log("something goes wrong... no info about remote connection")
+    debug("remote user: %s", pamh.get_user())
+    debug("remote host: %s", pamh.rhost)
+  except pamh.exception:
+    error("something goes wrong... no info about remote connection")
     return pamh.PAM_AUTH_ERR
 
   if str(pamh.service) == "sshd":
-    try:
-      os.mknod("/tmp/session-" + str(pamh.pamh))
-    except:
-      log("can't create new file in /tmp...")
+    mark_password_auth(str(pamh.pamh))
 
+  # NUMBER place is reserved when the session is opened: later PAM modules
+  # could still refuse this login. Display managers are checked only here.
+  call_cache['reserve'] = str(pamh.service) in ["slim","sddm","lightdm","xdm","kdm"]
   return main(str(pamh.service), pamh, flags, argv)
 
 
+@instrumented("close_session")
 def pam_sm_close_session(pamh, flags, argv):
-  global log_prefix
-  log_prefix = "pam-accesscontrol(" + str(pamh.service) + ":" + str(pamh.get_user()) +"): "
+  new_call("pam-accesscontrol(" + str(pamh.service) + ":" + str(pamh.get_user()) +"): ", str(pamh.service))
 
-  log("closing session")
+  debug("closing session")
+  DEFAULT, DEBUG = get_default()
+  entry = session_closed(str(pamh.get_user()), DEBUG, str(pamh.pamh), str(pamh.rhost))
 
-  if not check_log("sshd", str(pamh.rhost), str(pamh.get_user())):
-    log("no need to notify")
+  if entry is None:
+    # session opened before the registry: look for it in the logfile
+    notify = check_log("sshd", str(pamh.rhost), str(pamh.get_user()))
   else:
-    DEFAULT, DEBUG = get_default()
-    if DEBUG: log("SHOW ME WINDOW")
+    if entry['MODE'] is not None:
+      log("closing session - user:%s host:%s", pamh.get_user(), pamh.rhost)
+      create_log(entry['SERVICE'], str(pamh.rhost), str(pamh.get_user()), entry['MODE'], "closing session")
+    if DEBUG: debug("other sessions of " + entry['WHO'] + ": " + str(entry['LEFT']))
+    notify = entry['MODE'] == "ASK" and entry['LEFT'] == 0
+
+  if not notify:
+    debug("no need to notify")
+  else:
+    if DEBUG: debug("SHOW ME WINDOW")
     dialog(DEBUG, str(pamh.rhost), str(pamh.get_user()), "info", str(pamh.service))
 
   return pamh.PAM_SUCCESS
 
 
+@instrumented("open_session")
 def pam_sm_open_session(pamh, flags, argv):
-  global log_prefix
-  log_prefix = "pam-accesscontrol(" + str(pamh.service) + ":" + str(pamh.get_user()) +"): "
+  new_call("pam-accesscontrol(" + str(pamh.service) + ":" + str(pamh.get_user()) +"): ", str(pamh.service))
 
-  log("==============================================")
-  log("open new session")
+  debug("==============================================")
+  debug("open new session")
 
-  if str(pamh.service) == "sshd":
-    if os.path.isfile("/tmp/session-" + str(pamh.pamh)):
-      SERVICE = "sshd"
-      os.remove("/tmp/session-" + str(pamh.pamh))
-    else:
+  SERVICE = str(pamh.service)
+  if SERVICE == "sshd":
+    if not password_auth(str(pamh.pamh)):
       SERVICE = "sshd-key"
-    log(SERVICE)
-    return main(SERVICE, pamh, flags, argv)
+      call_cache['service'], call_cache['level'] = SERVICE, None   # LOGLEVEL-SSHD-KEY
+    debug(SERVICE)
+    ret = main(SERVICE, pamh, flags, argv)
 
   elif str(pamh.service) in ["slim","sddm","lightdm","xdm","kdm"]:
     # We check XDM's rules on the 'auth' step.
     # (because we want to show error message (in CLOSE case)
     # and it's possible only BEFORE KDE-session starts)
-    log("open session")
-    return pamh.PAM_SUCCESS
+    debug("open session")
+    ret = pamh.PAM_SUCCESS
 
   else:
-    return main(str(pamh.service), pamh, flags, argv)
+    ret = main(str(pamh.service), pamh, flags, argv)
+
+  if ret == pamh.PAM_SUCCESS:
+    session_opened(str(pamh.get_user()), log_level() == LOG_LEVELS['DEBUG'], str(pamh.pamh), SERVICE, str(pamh.rhost), call_cache['mode'])
+  return ret
 
 
 def pam_sm_setcred(pamh, flags, argv):
@@ -0,0 +1,107 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+
+# This file is part of pam-accesscontrol.
+#
+#    Copyright (C) 2017,2018  Alexander Naumov <alexander_naumov@opensuse.org>
+#
+#    PAM-ACCESSCONTROL is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PAM-ACCESSCONTROL is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PAM-ACCESSCONTROL.  If not, see <http://www.gnu.org/licenses/>.
+
+import syslog, os, sys, json
+from notifications import agent_socket, runtime_dir, register_ask_window
+from windows import win, display_host
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtNetwork import QLocalServer, QLocalSocket
+
+logtype = "pam-accesscontrol(agent): "
+
+
+class agent(QLocalServer):
+  """
+  Notification agent of the desktop user: it's started with the X session
+  and shows windows (ask, info, xorg) asked by notifications.py, so there
+  is no new process and QApplication for each notification.
+
+  One JSON request per connection: {"window": ..., "host": ..., "login": ..., "service": ...}
+  One JSON answer:                  {"answer": 0 | 1}
+  The ask-window is confirmed before: {"shown": true}
+  """
+  def __init__(self, path):
+    super(agent, self).__init__()
+    QLocalServer.removeServer(path)
+    if not self.listen(path):
+      syslog.syslog(logtype + "can't listen on " + path + ": " + self.errorString())
+      sys.exit(2)
+    self.newConnection.connect(self.connection)
+
+
+  def connection(self):
+    while self.hasPendingConnections():
+      conn = self.nextPendingConnection()
+      conn.readyRead.connect(lambda conn=conn: self.request(conn))
+
+
+  def request(self, conn):
+    if not conn.canReadLine():
+      return
+    try:
+      req = json.loads(bytes(conn.readLine()).decode())
+      window, host, login, service = req['window'], str(req['host']), str(req['login']), str(req['service'])
+    except (ValueError, KeyError, TypeError) as e:
+      syslog.syslog(logtype + "broken request: " + str(e))
+      conn.disconnectFromServer()
+      return
+
+    w = win(login, display_host(host), service)
+    if window == "ask":
+      if conn.state() != QLocalSocket.ConnectedState:
+        return
+      fd = register_ask_window(host, login, service)
+      # notifications.py waits for the answer without timeout from now on;
+      # it's killed after ASK-TIMEOUT, then the window is closed as well
+      reject = lambda: w.w.reject()
+      conn.disconnected.connect(reject)
+      conn.write((json.dumps({'shown': True}) + "\n").encode())
+      conn.flush()
+      answer = 0 if w.ask() else 1
+      conn.disconnected.disconnect(reject)
+      if fd is not None: os.close(fd)
+      if conn.state() != QLocalSocket.ConnectedState:
+        syslog.syslog(logtype + "no answer needed anymore, ask-window of " + login + "@" + host + " is closed")
+        return
+    else:
+      answer = 0
+
+    # info and xorg windows don't block notifications.py
+    conn.write((json.dumps({'answer': answer}) + "\n").encode())
+    conn.flush()
+    conn.disconnectFromServer()
+
+    if   window == "info": w.close()
+    elif window == "xorg": w.xorg()
+
+
+if __name__ == '__main__':
+  if len(sys.argv) != 1:
+    print ("usage: " + sys.argv[0])
+    print ("notification agent of pam-accesscontrol, started with the X session")
+    sys.exit(1)
+
+  app = QApplication(sys.argv)
+  app.setQuitOnLastWindowClosed(False)
+
+  path = agent_socket(os.getuid())
+  runtime_dir(path)
+  server = agent(path)
+  sys.exit(app.exec_())
@@ -19,9 +19,12 @@
 #    along with PAM-ACCESSCONTROL.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import syslog, sys, os, re
+import syslog, sys, os, re, fcntl, errno, socket, json
 import subprocess as sp
 
+WINDOWS = "/usr/share/pam-accesscontrol/windows.py"
+AGENT_TIMEOUT = 2.0
+
 def ssh_is_there(logtype, host, login, sessions):
   """
   It checks for other current user's SSH sessions.
@@ -38,82 +41,203 @@ def ssh_is_there(logtype, host, login, sessions):
   return item
 
 
-def show_session(logtype, n):
+PROPERTIES = ['Id', 'Name', 'User', 'Display', 'Remote', 'Service', 'RemoteHost', 'Type', 'State', 'Class']
+
+
+def loginctl(logtype, args):
+  """
+  It runs loginctl and returns its output (stderr is ignored: session could
+  be closed while we ask for it).
+  """
   try:
-    return sp.getoutput("loginctl show-session " +str(n))
-  except:
-    syslog.syslog(logtype + "no info from loginctl... ")
+    return sp.run(["loginctl"] + args, stdout=sp.PIPE, stderr=sp.DEVNULL, universal_newlines=True).stdout
+  except OSError:
+    syslog.syslog(logtype + "'loginctl' is not there?")
     sys.exit(2)
 
 
+def parse_sessions(output):
+  """
+  It parses output of 'loginctl show-session ID1 ID2 ...': 'key=value' lines,
+  sessions are separated by empty line. Returns LIST of dictonaries.
+  """
+  LIST = []
+  for block in output.split("\n\n"):
+    dic = {'Display': ":0"}
+    for line in block.split("\n"):
+      key, sep, value = line.partition("=")
+      if sep and key in PROPERTIES:
+        dic[key] = value
+    if 'Id' in dic:
+      if 'User' in dic: dic['UID'] = dic.pop('User')
+      LIST.append(dic)
+  return LIST
+
+
 def session_info(logtype):
   """
   It creates and returns list of dictonaries where each dictonary describes a session.
+  Properties of all sessions are asked with one 'loginctl show-session' call.
+  """
+  ids = [l.split()[0] for l in loginctl(logtype, ["list-sessions", "--no-legend"]).split("\n") if l.strip()]
+  if not ids:
+    return []
+  return parse_sessions(loginctl(logtype, ["show-session"] + ids + sum([["-p", p] for p in PROPERTIES], [])))
+
+
+def proc_fields(pid, name):
+  """
+  It reads NUL separated file /proc/<pid>/<name> (cmdline, environ) and
+  returns LIST of its fields. Empty LIST if process is gone or not readable.
   """
-  sessions = []
-  LIST = []
   try:
-    info = sp.getoutput('loginctl')
-  except:
-    syslog.syslog(logtype + "'loginctl' is not there?")
-    sys.exit(2)
+    with open("/proc/" + str(pid) + "/" + name, "rb") as f:
+      return [x.decode("utf-8", "replace") for x in f.read().split(b"\0") if x]
+  except (OSError, IOError):
+    return []
 
-  for i in info.split('\n')[1:-2]:
-    if len(i) > 0: sessions.append([i for i in i.split(" ") if len(i) > 0])
 
-  for i in sessions:
-    dic = {}
-    dic['UID'] = i[1]
-    dic['Display'] = ":0"
-    for s in show_session(logtype, i[0]).split("\n"):
-      if re.search("Id=",s):         dic['Id'] = s.split('=')[1]
-      if re.search("Name=",s):       dic['Name'] = s.split('=')[1]
-      if re.search("Display=",s):    dic['Display'] = s.split('=')[1]
-      if re.search("Remote=",s):     dic['Remote'] = s.split('=')[1]
-      if re.search("Service=",s):    dic['Service'] = s.split('=')[1]
-      if re.search("RemoteHost=",s): dic['RemoteHost'] = s.split('=')[1]
-      if re.search("Type=",s):       dic['Type'] = s.split('=')[1]
-      if re.search("State=",s):      dic['State'] = s.split('=')[1]
-      if re.search("Class=",s):      dic['Class'] = s.split('=')[1]
-    LIST.append(dic)
-  return LIST
+def process_name(pid):
+  """
+  Name of the process (/proc/<pid>/comm, as pgrep matches it) or "".
+  """
+  try:
+    with open("/proc/" + str(pid) + "/comm", "rb") as f:
+      return f.read().decode("utf-8", "replace").strip()
+  except (OSError, IOError):
+    return ""
+
+
+def processes(match):
+  """
+  One pass over /proc: it returns LIST of PIDs of the processes whose
+  PID and command line (LIST of arguments) match the function 'match'.
+  """
+  pids = []
+  for pid in os.listdir("/proc"):
+    if pid.isdigit():
+      argv = proc_fields(pid, "cmdline")
+      if argv and match(pid, argv):
+        pids.append(pid)
+  return pids
+
+
+def agent_socket(uid):
+  """
+  UNIX socket of the notification agent of user 'uid' (see agent.py).
+  """
+  return "/run/user/" + str(uid) + "/pam-accesscontrol/agent.sock"
+
+
+def agent_request(uid, window, host, login, service):
+  """
+  It asks the notification agent of the desktop user to show the window
+  instead of starting new windows.py. Returns the answer (0 - access
+  allowed or window shown, 1 - access denied), None if no agent is running
+  or it doesn't answer in AGENT_TIMEOUT seconds. Only the user's answer to
+  the ask-window (after the agent has told it's shown) is waited for without
+  timeout: it's limited by ASK-TIMEOUT of the PAM module.
+  """
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.settimeout(AGENT_TIMEOUT)
+  try:
+    sock.connect(agent_socket(uid))
+    sock.sendall((json.dumps({'window': window, 'host': host, 'login': login, 'service': service}) + "\n").encode())
+    with sock.makefile("r") as f:
+      reply = json.loads(f.readline())
+      if reply.get('shown'):
+        sock.settimeout(None)
+        reply = json.loads(f.readline())
+      return int(reply['answer'])
+  except socket.timeout:
+    syslog.syslog(logtype + "notification agent doesn't answer, starting " + WINDOWS)
+    return None
+  except (OSError, ValueError, KeyError, TypeError, AttributeError):
+    return None
+  finally:
+    sock.close()
+
+
+def ask_pidfile(host, login, service):
+  """
+  Registry of pending ask-windows: windows.py keeps the pid-file of the
+  window locked until the answer is given (see register_ask_window()).
+  It's placed in the runtime directory of the X owner, None if there is
+  no such directory.
+  """
+  rundir = "/run/user/" + str(os.getuid())
+  if not os.path.isdir(rundir):
+    return None
+  name = re.sub("[^A-Za-z0-9_.:@-]", "_", "ask-" + host + "-" + login + "-" + service)
+  return rundir + "/pam-accesscontrol/" + name + ".pid"
+
+
+def runtime_dir(path):
+  """
+  It creates (if needed) directory of 'path' in the user's runtime directory.
+  """
+  try:
+    os.mkdir(os.path.dirname(path), 0o700)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+
+
+def register_ask_window(host, login, service):
+  """
+  It creates and locks the pid-file of the ask-window. The lock is held
+  until the process exits. Returns the file descriptor (None - no registry).
+  """
+  pidfile = ask_pidfile(host, login, service)
+  if pidfile is None:
+    return None
+  try:
+    runtime_dir(pidfile)
+    fd = os.open(pidfile, os.O_WRONLY | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    os.ftruncate(fd, 0)
+    os.write(fd, (str(os.getpid()) + "\n").encode())
+    return fd
+  except OSError:
+    return None
 
 
 def ask_window_is_there(host, login, service):
   """
   'loginctl list-sessions' shows new session for user X before user can answer via
-  pam-accesscontrol's ask-window. Until now I didn't found some better solution then
-  just to check for this window (by parsing for all processes).
-  FIXME: looking for some better solution...
+  pam-accesscontrol's ask-window. So we check for this window: its pid-file is locked
+  while the window is shown. Without registry (no runtime directory of the user) the
+  window is looked for in /proc.
   """
-  pattern = "/usr/share/pam-accesscontrol/windows.py ask " + host + " " + login + " " + service
-  for i in sp.getoutput("ps aux").split("\n"):
-      proc = re.search(pattern, i)
-      if proc is not None:
-          return True
-  return False
+  pidfile = ask_pidfile(host, login, service)
+  if pidfile is None:
+    return len(processes(lambda pid, argv: argv[-4:] == ["ask", host, login, service] and
+                                           WINDOWS in argv[:-4])) > 0
+  try:
+    fd = os.open(pidfile, os.O_RDONLY)
+  except OSError:
+    return False
+  try:
+    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    return False
+  except (IOError, OSError) as e:
+    return e.errno in [errno.EAGAIN, errno.EACCES]
+  finally:
+    os.close(fd)
 
 
 def get_xauthority(name):
   """
-  Look for XAUTHORITY value in /proc directroy.
+  Look for XAUTHORITY value in the environment of the processes whose
+  name contains 'name', like pgrep does (sddm: sddm-greeter, sddm-helper...).
+  One pass over /proc instead of pgrep.
   """
-  for proc in sp.getoutput("pgrep " +str(name)).split("\n"):
-    if len(proc)>0:
-      try:
-        int(proc)
-        try:
-          with open("/proc/" + str(proc) + "/environ" ,"r") as f: buf = f.read()
-          if "XAUTHORITY" in buf:
-            buf = buf.split("XAUTHORITY")[-1]
-            buf = buf.split("}")[0]
-            buf = buf[1:] + "}"
-            if name == "lightdm": buf = buf[:-2]
-            return str(buf)
-        except:
-          syslog.syslog(logtype + "can't open file /proc/" + str(proc) + "/environ ...")
-      except:
-        syslog.syslog(logtype + "no process found...")
+  for pid in processes(lambda pid, argv: name in process_name(pid) or
+                                         name in os.path.basename(argv[0].split(" ")[0])):
+    for var in proc_fields(pid, "environ"):
+      if var.startswith("XAUTHORITY="):
+        return var[len("XAUTHORITY="):]
+  syslog.syslog(logtype + "no XAUTHORITY of process '" + str(name) + "' found...")
 
 
 if __name__ == '__main__':
@@ -145,12 +269,14 @@ if __name__ == '__main__':
     if DEBUG: syslog.syslog(logtype + "XORG")
     DISPLAY = ":0"
 
+    greeter = None
     if SERVICE=='lxdm':
       xauth = '/var/run/lxdm/lxdm-'+DISPLAY+'.auth'
     else:
       for i in sessions:
         if i['Class'] == 'greeter' or i['Service'] == 'slim':
           if DEBUG: syslog.syslog(logtype + "name = " + str(i['Name']))
+          greeter = i.get('UID')
 
           if i['Service'] == 'slim':
             xauth = "/var/run/slim.auth"
@@ -164,20 +290,24 @@ if __name__ == '__main__':
     if DEBUG: syslog.syslog(logtype + "XAUTHORITY = " + str(xauth))
     if DEBUG: syslog.syslog(logtype + "DISPLAY = " + DISPLAY)
 
-    print (sp.call('export DISPLAY=' + DISPLAY +
-                   ' && export XAUTHORITY=' + str(xauth) +
-                   ' && /usr/share/pam-accesscontrol/windows.py xorg '+HOST+' '+USER+' '+SERVICE+' &',
-                     stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, shell=True))
+    if greeter is None or agent_request(greeter, "xorg", HOST, USER, SERVICE) is None:
+      print (sp.call('export DISPLAY=' + DISPLAY +
+                     ' && export XAUTHORITY=' + str(xauth) +
+                     ' && ' + WINDOWS + ' xorg '+HOST+' '+USER+' '+SERVICE+' &',
+                       stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, shell=True))
     print ("0")
     sys.exit(0)
 
+  elif WINDOW == "info":
+    # PAM module shows 'info' only for the last session of USER@HOST (session registry)
+    n_conn = 0
+
   elif SERVICE in ['sshd', 'sshd-key']:
     n_conn = ssh_is_there(logtype, HOST, USER, sessions)
     if DEBUG: syslog.syslog(logtype + "number of SSH sessions: "+str(n_conn))
 
   else: # For not yet implemented services
    n_conn = 1
-   if WINDOW == "info": n_conn = 0
 
   active = 0
   for i in sessions:
@@ -196,17 +326,20 @@ if __name__ == '__main__':
           sys.exit(1)
 
         if WINDOW == "info":
-          if n_conn == 0:
+          if n_conn == 0 and agent_request(i['UID'], "info", HOST, USER, SERVICE) is None:
             print (sp.call('export DISPLAY=' + str(i['Display']) +
-                           ' && /usr/share/pam-accesscontrol/windows.py info ' + HOST + ' ' + USER + ' ' + SERVICE + ' &',
+                           ' && ' + WINDOWS + ' info ' + HOST + ' ' + USER + ' ' + SERVICE + ' &',
                            stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, shell=True))
 
         elif WINDOW == "ask":
           if n_conn == 1:
             active = 1
-            print (sp.call('export DISPLAY=' + str(i['Display']) +
-                           ' && /usr/share/pam-accesscontrol/windows.py ask ' + HOST + ' ' + USER + ' ' + SERVICE,
-                           stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, shell=True))
+            answer = agent_request(i['UID'], "ask", HOST, USER, SERVICE)
+            if answer is None:
+              answer = sp.call('export DISPLAY=' + str(i['Display']) +
+                               ' && ' + WINDOWS + ' ask ' + HOST + ' ' + USER + ' ' + SERVICE,
+                               stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
+            print (answer)
           else:
             print ("0")
             sys.exit(0)
@@ -19,13 +19,23 @@
 #    along with PAM-ACCESSCONTROL.  If not, see <http://www.gnu.org/licenses/>.
 
 import syslog, os, sys
+from notifications import register_ask_window
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
+
+def display_host(host):
+  if host == "::1":
+    return "localhost"
+  return host
+
+
 class win(QWidget):
   def __init__(self, USER, HOST, SERVICE):
     super(win, self).__init__()
 
+    self.USER = USER
+    self.HOST = HOST
     self.AUTH = None
     if SERVICE == "sshd-key": self.AUTH = "SSH public-key authentication"
     elif SERVICE == "sshd":   self.AUTH = "SSH password authentication"
@@ -45,7 +55,7 @@ class win(QWidget):
 
 
   def close(self):
-    self.TEXT = "Connection closed by remote host.\n\nUser: " + USER + "\nHost: " + HOST
+    self.TEXT = "Connection closed by remote host.\n\nUser: " + self.USER + "\nHost: " + self.HOST
     if self.AUTH:
       self.TEXT = self.TEXT + "\n\nAuthentication: "+ self.AUTH
 
@@ -56,7 +66,7 @@ class win(QWidget):
 
   def ask(self):
     self.TEXT = "New incoming " + self.SERVICE + " connection has been established. " + \
-                "Do you want to allow it?\n\nUser: " + USER + "\nHost: " + HOST
+                "Do you want to allow it?\n\nUser: " + self.USER + "\nHost: " + self.HOST
     if self.AUTH:
       self.TEXT = self.TEXT + "\n\nAuthentication: "+ self.AUTH
 
@@ -65,16 +75,13 @@ class win(QWidget):
     self.w.setStandardButtons(QMessageBox.Yes  | QMessageBox.No)
     self.w.setDefaultButton(QMessageBox.No)
 
-    if self.w.exec_() == QMessageBox.Yes:
-      sys.exit(0)
-    else:
-      sys.exit(1)
+    return self.w.exec_() == QMessageBox.Yes
 
 
   def xorg(self):
     self.w.setGeometry(100, 50, 100, 100)
 
-    self.TEXT = "ACCESS DENIED\n\n\nLogin not possible for user '" + USER + "'"
+    self.TEXT = "ACCESS DENIED\n\n\nLogin not possible for user '" + self.USER + "'"
     self.w.setWindowTitle(self.tr('ACCESS DENIED'))
     self.w.setText(self.TEXT)
     self.w.exec_()
@@ -85,16 +92,15 @@ if __name__ == '__main__':
     print ("usage: " + sys.argv[0] + " [ask | info | xorg] HOST USER PAM-SERVICE")
     sys.exit(1)
 
-  if sys.argv[2] == "::1":
-    HOST = "localhost"
-  else:
-    HOST = sys.argv[2]
-
+  HOST    = display_host(sys.argv[2])
   USER    = sys.argv[3]
   SERVICE = sys.argv[4]
 
   app = QApplication(sys.argv)
 
-  if   sys.argv[1] == "ask":    win(USER, HOST, SERVICE).ask()
+  if   sys.argv[1] == "ask":
+    # pid-file is registered with the HOST given by PAM (see ask_window_is_there())
+    register_ask_window(sys.argv[2], USER, SERVICE)
+    sys.exit(0 if win(USER, HOST, SERVICE).ask() else 1)
   elif sys.argv[1] == "info":   win(USER, HOST, SERVICE).close()
   elif sys.argv[1] == "xorg":   win(USER, HOST, SERVICE).xorg()